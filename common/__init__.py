@@ -0,0 +1,5 @@
+# Helpers shared by the homework scripts.
+# The scripts run from their own hw directory and put the repository root on sys.path to import them.
+
+from .metrics import MetricAccumulator
+from .focal_loss import FocalLoss
@@ -0,0 +1,60 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd.function import once_differentiable
+
+
+class FocalLossFunction(torch.autograd.Function):
+    '''
+    loss_i = -alpha[t_i] * (1 - p_i)^gamma * log p_i, with p_i the softmax probability of the target class.
+    As in the original FocalLoss, the factor (1 - p_i)^gamma is treated as a constant, so the gradient with
+    respect to the logits is w_i * (softmax_i - onehot(t_i)), w_i = alpha[t_i] * (1 - p_i)^gamma.
+    Only the softmax (written over the log-softmax buffer) and w are kept for backward.
+    '''
+    @staticmethod
+    def forward(ctx, input, target, gamma, alpha, size_average):
+        prob = F.log_softmax(input, dim=1)
+        logpt = prob.gather(1, target.unsqueeze(1)).squeeze(1)
+        weight = (1 - logpt.exp()) ** gamma
+        if alpha is not None:
+            weight = weight * alpha.gather(0, target)
+        loss = -(weight * logpt)
+        loss = loss.mean() if size_average else loss.sum()
+
+        prob.exp_() # log-softmax -> softmax in place, no second (N, C) buffer
+        ctx.save_for_backward(prob, target, weight)
+        ctx.size_average = size_average
+        return loss
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        prob, target, weight = ctx.saved_tensors
+        scale = grad_output / len(target) if ctx.size_average else grad_output
+        coef = (weight * scale).unsqueeze(1)
+        grad = prob * coef
+        grad.scatter_add_(1, target.unsqueeze(1), -coef)
+        return grad, None, None, None, None
+
+
+class FocalLoss(nn.Module):
+    '''
+    Focal loss over class logits, numerically the same as the FocalLoss the homeworks used to copy.
+    alpha: None, a float (binary task: [alpha, 1 - alpha]) or a list of per-class weights.
+    '''
+    def __init__(self, gamma=2, alpha=None, size_average=True):
+        super(FocalLoss, self).__init__()
+        self.gamma = gamma
+        if isinstance(alpha, (float, int)): alpha = [alpha, 1 - alpha]
+        # A buffer follows the module across .to(device), so it is not re-cast on every call.
+        # forward still moves it to the device and dtype of the input if the module was not moved, as type_as used to.
+        self.register_buffer('alpha', torch.tensor(alpha, dtype=torch.float32) if alpha is not None else None)
+        self.size_average = size_average
+
+    def forward(self, input, target):
+        if input.dim() > 2:
+            input = input.view(input.size(0), input.size(1), -1)  # N,C,H,W => N,C,H*W
+            input = input.transpose(1, 2)                          # N,C,H*W => N,H*W,C
+            input = input.contiguous().view(-1, input.size(2))     # N,H*W,C => N*H*W,C
+        alpha = self.alpha.to(input) if self.alpha is not None else None
+        return FocalLossFunction.apply(input, target.view(-1), self.gamma, alpha, self.size_average)
@@ -0,0 +1,38 @@
+import torch
+
+
+class MetricAccumulator:
+    '''
+    Running sums of training metrics, kept as float64 tensors on the device.
+    update() only queues an add on the device, so the training loop never waits for the GPU to report a value;
+    compute() / means() copy every sum back to the host in a single transfer, once per epoch or logging interval.
+    '''
+    def __init__(self, device='cpu'):
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+
+    def update(self, n=1, **values):
+        '''Adds every value (tensor or number) to its running sum and n to its count.'''
+        for name, value in values.items():
+            if torch.is_tensor(value):
+                value = value.detach()
+            total = self.sums.get(name)
+            if total is None:
+                total = self.sums[name] = torch.zeros((), dtype=torch.float64, device=self.device)
+            total.add_(value)
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def compute(self):
+        '''Sum of every metric as a python float.'''
+        names = list(self.sums)
+        if not names:
+            return {}
+        return dict(zip(names, torch.stack([self.sums[name] for name in names]).tolist()))
+
+    def means(self):
+        '''Sum of every metric divided by its count.'''
+        return {name: total / self.counts[name] for name, total in self.compute().items()}
@@ -1,11 +1,19 @@
 # Numerical Operations
 import math
+import time
 import numpy as np
 
 # Reading/Writing Data
 import pandas as pd
 import os
 import csv
+import hashlib
+import contextlib
+import threading
+try:
+    import resource # Peak RSS, not available on Windows.
+except ImportError:
+    resource = None
 from torch.nn.modules.batchnorm import BatchNorm1d
 
 # For Progress Bar
@@ -14,7 +22,7 @@ from tqdm import tqdm
 # Pytorch
 import torch 
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Dataset, DataLoader
 
 # For plotting learning curve
 from torch.utils.tensorboard import SummaryWriter
@@ -76,12 +84,26 @@ def same_seed(seed):
     if torch.cuda.is_available():
         torch.cuda.manual_seed_all(seed)
 
+def train_valid_split_idx(n, valid_ratio, seed):
+    '''Returns the row indices of the training set and validation set, the same rows random_split picks for this seed'''
+    valid_set_size = int(valid_ratio * n) 
+    train_set_size = n - valid_set_size
+    # random_split takes consecutive chunks of one randperm drawn from the seeded generator.
+    perm = torch.randperm(n, generator=torch.Generator().manual_seed(seed)).numpy()
+    return perm[:train_set_size], perm[train_set_size:]
+
 def train_valid_split(data_set, valid_ratio, seed):
     '''Split provided training data into training set and validation set'''
-    valid_set_size = int(valid_ratio * len(data_set)) 
-    train_set_size = len(data_set) - valid_set_size
-    train_set, valid_set = random_split(data_set, [train_set_size, valid_set_size], generator=torch.Generator().manual_seed(seed))
-    return np.array(train_set), np.array(valid_set)
+    train_idx, valid_idx = train_valid_split_idx(len(data_set), valid_ratio, seed)
+    # One fancy-index gather per set instead of materialising every row of a Subset.
+    return data_set[train_idx], data_set[valid_idx]
+
+def kfold_split_idx(n, k, seed):
+    '''Yields (train_idx, valid_idx) of each of the k folds, only indices are built so the data is never copied per fold'''
+    perm = torch.randperm(n, generator=torch.Generator().manual_seed(seed)).numpy()
+    folds = np.array_split(perm, k)
+    for i in range(k):
+        yield np.concatenate(folds[:i] + folds[i+1:]), folds[i]
 
 def predict(test_loader, model, device):
     model.eval() # Set your model to evaluation mode.
@@ -94,6 +116,35 @@ def predict(test_loader, model, device):
     preds = torch.cat(preds, dim=0).numpy()  
     return preds
 
+# Reading Data
+
+def read_csv_cached(path, usecols=None, cache_dir='./cache'):
+    '''
+    Reads the given column positions of a csv as float32, in the order of usecols.
+    The result is saved as a .npy snapshot keyed by the csv's mtime and content hash,
+    later calls memory-map that snapshot instead of parsing the csv again.
+    '''
+    digest = hashlib.sha1(f'{os.stat(path).st_mtime_ns}:{usecols}'.encode())
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b''):
+            digest.update(chunk)
+    name = os.path.splitext(os.path.basename(path))[0]
+    cache_path = os.path.join(cache_dir, f'{name}.{digest.hexdigest()[:16]}.npy')
+
+    if not os.path.exists(cache_path):
+        header = pd.read_csv(path, nrows=0).columns
+        names = list(header if usecols is None else header[usecols])
+        # pandas returns usecols in file order, so reorder them by name.
+        data = pd.read_csv(path, usecols=names, dtype=np.float32)[names].to_numpy()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            np.save(fp, data)
+        os.replace(tmp_path, cache_path) # Never leave a partial snapshot behind.
+
+    return np.load(cache_path, mmap_mode='r')
+
 # Dataset
 
 class COVID19Dataset(Dataset):
@@ -119,22 +170,60 @@ class COVID19Dataset(Dataset):
     def __len__(self):
         return len(self.x)
 
+class TensorBatchLoader:
+    '''
+    Drop-in replacement of DataLoader for a COVID19Dataset whose tensors already live in memory.
+    Each epoch draws one permutation and yields slices of the resident tensors,
+    so the Python overhead is one step per batch instead of one __getitem__ per row.
+    The global RNG is consumed exactly like DataLoader(shuffle=True), so a given seed gives the same batches.
+    '''
+    def __init__(self, dataset, batch_size=1, shuffle=False, drop_last=False, device=None):
+        self.x, self.y = dataset.x, dataset.y
+        if device is not None:
+            self.x = self.x.to(device)
+            self.y = None if self.y is None else self.y.to(device)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.x) // self.batch_size
+        return (len(self.x) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.x)
+        # DataLoader draws a base seed for its workers on every iteration, then RandomSampler draws its own seed.
+        torch.empty((), dtype=torch.int64).random_()
+        if self.shuffle:
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+            order = torch.randperm(n, generator=torch.Generator().manual_seed(seed)).to(self.x.device)
+        else:
+            order = None
+
+        end = len(self) * self.batch_size
+        for start in range(0, min(end, n), self.batch_size):
+            if order is None:
+                x = self.x[start: start + self.batch_size]
+                y = None if self.y is None else self.y[start: start + self.batch_size]
+            else:
+                idx = order[start: start + self.batch_size]
+                x = self.x[idx]
+                y = None if self.y is None else self.y[idx]
+            yield x if y is None else (x, y)
+
 # Neural Network Model
 
 class My_Model(nn.Module):
-    def __init__(self, input_dim):
+    def __init__(self, input_dim, widths=(512, 256, 64, 32)):
         super(My_Model, self).__init__()
         # TODO: modify model's structure, be aware of dimensions. 
+        layers = []
+        for in_dim, out_dim in zip((input_dim,) + tuple(widths), tuple(widths)):
+            layers += [nn.Linear(in_dim, out_dim), nn.SiLU()]
         self.layers = nn.Sequential(
-            nn.Linear(input_dim, 512),
-            nn.SiLU(),
-            nn.Linear(512, 256),
-            nn.SiLU(),
-            nn.Linear(256, 64),
-            nn.SiLU(),
-            nn.Linear(64, 32),
-            nn.SiLU(),
-            nn.Linear(32, 1)
+            *layers,
+            nn.Linear(widths[-1], 1)
         )
 
     def forward(self, x):
@@ -142,14 +231,49 @@ class My_Model(nn.Module):
         x = x.squeeze(1) # (B, 1) -> (B)
         return x
 
-# Feature Selection
-def select_feat(train_data, valid_data, test_data, select_all):
-    '''Selects useful features to perform regression'''
-    y_train, y_valid = train_data[:,-1], valid_data[:,-1]
-    raw_x_train, raw_x_valid, raw_x_test = train_data[:,:-1], valid_data[:,:-1], test_data
+class Ensemble_Model(nn.Module):
+    '''
+    K replicas of My_Model with their weights stacked along a leading dimension.
+    x: (K, B, input_dim) -> (K, B), every Linear runs as one batched matmul for all replicas.
+    '''
+    def __init__(self, models):
+        super(Ensemble_Model, self).__init__()
+        self.n_models = len(models)
+        # Activations are element-wise and stateless, so replica 0's modules serve every replica.
+        self.stages = nn.ModuleList()
+        self.weights, self.biases = nn.ParameterList(), nn.ParameterList()
+        for i, layer in enumerate(models[0].layers):
+            if isinstance(layer, nn.Linear):
+                self.stages.append(nn.Identity())
+                self.weights.append(nn.Parameter(torch.stack([m.layers[i].weight.detach().t() for m in models])))
+                self.biases.append(nn.Parameter(torch.stack([m.layers[i].bias.detach() for m in models]).unsqueeze(1)))
+            else:
+                self.stages.append(layer)
+        self.linear_idx = [i for i, layer in enumerate(models[0].layers) if isinstance(layer, nn.Linear)]
 
+    def forward(self, x):
+        j = 0
+        for i, stage in enumerate(self.stages):
+            if i in self.linear_idx:
+                x = torch.baddbmm(self.biases[j], x, self.weights[j]) # (K, B, in) @ (K, in, out) + (K, 1, out)
+                j += 1
+            else:
+                x = stage(x)
+        return x.squeeze(2) # (K, B, 1) -> (K, B)
+
+    def replica_state_dict(self, k):
+        '''Returns the state dict of replica k, loadable by My_Model.'''
+        state = {}
+        for i, w, b in zip(self.linear_idx, self.weights, self.biases):
+            state[f'layers.{i}.weight'] = w[k].detach().t().contiguous().cpu()
+            state[f'layers.{i}.bias'] = b[k, 0].detach().clone().cpu()
+        return state
+
+# Feature Selection
+def select_feat_idx(n_feat, select_all):
+    '''Returns the feature columns (of the csv without its target column) used for regression'''
     if select_all:
-        feat_idx = list(range(raw_x_train.shape[1]))
+        feat_idx = list(range(n_feat))
     else:
         # sklearn K = 60
         # feat_idx = [101, 86, 85, 70, 69, 54, 53, 38, 37, 113, 97, 81, 65, 49, 107, 91, 75, 59, 43]# TODO: Select suitable feature columns.
@@ -159,11 +283,178 @@ def select_feat(train_data, valid_data, test_data, select_all):
         
         # sklearn K = 5
         # feat_idx = [100, 84, 68, 52, 103, 87, 104, 71, 39, 56, 40, 102, 101, 86, 85, 70, 69, 54, 53, 38, 37]
+    return feat_idx
+
+def select_feat(train_data, valid_data, test_data, select_all):
+    '''Selects useful features to perform regression'''
+    y_train, y_valid = train_data[:,-1], valid_data[:,-1]
+    raw_x_train, raw_x_valid, raw_x_test = train_data[:,:-1], valid_data[:,:-1], test_data
+
+    feat_idx = select_feat_idx(raw_x_train.shape[1], select_all)
     return raw_x_train[:,feat_idx], raw_x_valid[:,feat_idx], raw_x_test[:,feat_idx], y_train, y_valid
 
+# Closed-form baseline
+
+def ridge_fit(x, y, alpha):
+    '''Closed-form ridge regression y ~ x @ w + b, the bias is not regularized.'''
+    x = torch.cat([x, torch.ones(len(x), 1, dtype=x.dtype, device=x.device)], dim=1).double()
+    reg = torch.eye(x.shape[1], dtype=x.dtype, device=x.device) * alpha
+    reg[-1, -1] = 0
+    w = torch.linalg.solve(x.T @ x + reg, x.T @ y.double())
+    return w[:-1].float(), w[-1].float()
+
+def full_batch(loader):
+    '''Returns the whole (x, y) of a DataLoader or TensorBatchLoader.'''
+    data = loader if isinstance(loader, TensorBatchLoader) else loader.dataset
+    return data.x, data.y
+
+def ridge_warm_start(train_loader, valid_loader, model, alpha, device):
+    '''
+    Fits ridge on the selected features as a baseline, then warm starts the model by solving
+    its output layer in closed form on the features of the layers below it.
+    '''
+    criterion = nn.MSELoss(reduction='mean')
+    (x_train, y_train), (x_valid, y_valid) = full_batch(train_loader), full_batch(valid_loader)
+    x_train, y_train, x_valid, y_valid = x_train.to(device), y_train.to(device), x_valid.to(device), y_valid.to(device)
+
+    w, b = ridge_fit(x_train, y_train, alpha)
+    print(f'Ridge baseline (alpha={alpha}): Train loss: {criterion(x_train @ w + b, y_train).item():.4f}, Valid loss: {criterion(x_valid @ w + b, y_valid).item():.4f}')
+
+    with torch.no_grad():
+        hidden, head = model.layers[:-1], model.layers[-1]
+        w, b = ridge_fit(hidden(x_train), y_train, alpha)
+        head.weight.copy_(w.view(1, -1))
+        head.bias.fill_(b.item())
+        print(f'Warm start: Valid loss: {criterion(model(x_valid), y_valid).item():.4f}')
+
+# Checkpointing
+
+class AsyncCheckpointWriter:
+    '''
+    Saves state dicts from a background thread so training does not wait for the disk.
+    save() snapshots the tensors to CPU and returns, if a newer best arrives before the previous
+    one is written only the newest is kept. Files are written to a temp file and renamed over
+    the target, so a crash never leaves a truncated checkpoint behind.
+    '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = None # (state_dict, path) waiting to be written
+        self.busy = False
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, state_dict, path):
+        snapshot = {k: v.detach().to('cpu', copy=True) for k, v in state_dict.items()}
+        with self.cond:
+            self._raise_error()
+            self.pending = (snapshot, path) # Replaces a best that was not written yet.
+            self.cond.notify_all()
+
+    def _write(self, state_dict, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            torch.save(state_dict, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+                if self.pending is None:
+                    return
+                (state_dict, path), self.pending = self.pending, None
+                self.busy = True
+            try:
+                self._write(state_dict, path)
+            except Exception as e:
+                self.error = e
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        '''Blocks until every saved checkpoint is on disk.'''
+        with self.cond:
+            while self.pending is not None or self.busy:
+                self.cond.wait()
+            self._raise_error()
+
+    def close(self):
+        self.flush()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+# Profiling
+
+class PhaseTimer:
+    '''
+    Accumulates the wall time of every phase of an epoch, and logs them with the peak RSS to tensorboard.
+    When disabled, phase() returns a shared null context and iterate() the iterable itself, so it costs nothing.
+    '''
+    _null = contextlib.nullcontext()
+
+    def __init__(self, enabled, device):
+        self.enabled = enabled
+        self.sync = enabled and str(device).startswith('cuda') # cuda kernels are async, wait for them before reading the clock.
+        self.totals = {}
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def _measure(self, name):
+        start = self._now()
+        yield
+        self.totals[name] = self.totals.get(name, 0.0) + self._now() - start
+
+    def phase(self, name):
+        return self._measure(name) if self.enabled else self._null
+
+    def _iterate(self, iterable, name):
+        it = iter(iterable)
+        while True:
+            with self._measure(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def iterate(self, iterable, name):
+        '''Times every next() of the iterable, i.e. the time spent waiting for the loader.'''
+        return self._iterate(iterable, name) if self.enabled else iterable
+
+    def log(self, writer, step):
+        '''Writes the totals of this epoch to tensorboard and starts the next epoch from zero.'''
+        if not self.enabled:
+            return
+        for name, seconds in self.totals.items():
+            writer.add_scalar(f'Time/{name}', seconds, step)
+        if resource is not None:
+            writer.add_scalar('Memory/peak_rss_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, step) # ru_maxrss is in KB on Linux.
+        self.totals = {}
+
 # Training Loop
 
-def trainer(train_loader, valid_loader, model, config, device):
+def trainer(train_loader, valid_loader, model, config, device, report=None):
+    '''
+    report: optional callable(epoch, mean_valid_loss) called after every validation,
+    training stops early when it returns True (used by the sweep runner to prune trials).
+    '''
     criterion = nn.MSELoss(reduction='mean') 
     # Define your loss function, do not modify this.
 
@@ -171,7 +462,16 @@ def trainer(train_loader, valid_loader, model, config, device):
     # TODO: Please check https://pytorch.org/docs/stable/optim.html to get more available algorithms.
     # TODO: L2 regularization (optimizer(weight decay...) or implement by your self).
     #optimizer = torch.optim.Adam(model.parameters(), lr=config['learning_rate'], weight_decay= 1e-5) 
-    optimizer = torch.optim.SGD(model.parameters(), lr=config['learning_rate'], momentum=0.8, weight_decay=1e-5) 
+    start_time = time.perf_counter()
+    if config.get('ridge_alpha') is not None:
+        ridge_warm_start(train_loader, valid_loader, model, config['ridge_alpha'], device)
+
+    if config.get('optimizer', 'sgd') == 'lbfgs_fullbatch':
+        # The training set fits in one batch, so every epoch is one L-BFGS step over all of it.
+        optimizer = torch.optim.LBFGS(model.parameters(), lr=1, max_iter=20, history_size=100, line_search_fn='strong_wolfe')
+        x_full, y_full = (t.to(device) for t in full_batch(train_loader))
+    else:
+        optimizer = torch.optim.SGD(model.parameters(), lr=config['learning_rate'], momentum=config.get('momentum', 0.8), weight_decay=1e-5) 
     
 
 
@@ -179,73 +479,236 @@ def trainer(train_loader, valid_loader, model, config, device):
 
     if not os.path.isdir('./models'):
         os.mkdir('./models') # Create directory of saving models.
+    ckpt_writer = AsyncCheckpointWriter()
 
     n_epochs, best_loss, step, early_stop_count = config['n_epochs'], math.inf, 0, 0
-
-    for epoch in range(n_epochs):
-        model.train() # Set your model to train mode.
-        loss_record = []
-
-        # tqdm is a package to visualize your training progress.
-        train_pbar = tqdm(train_loader, position=0, leave=True)
-
-        for x, y in train_pbar:
-            optimizer.zero_grad()               # Set gradient to zero.
-            x, y = x.to(device), y.to(device)   # Move your data to device. 
-            pred = model(x)             
-            loss = criterion(pred, y)
-            loss.backward()                     # Compute gradient(backpropagation).
-            optimizer.step()                    # Update parameters.
-            step += 1
-            loss_record.append(loss.detach().item())
+    target_mse, time_to_target = config.get('target_mse'), None
+    timer = PhaseTimer(config.get('profile', False), device)
+
+    try:
+        for epoch in range(n_epochs):
+            model.train() # Set your model to train mode.
+            loss_record = []
+
+            if isinstance(optimizer, torch.optim.LBFGS):
+                def closure():
+                    optimizer.zero_grad()
+                    loss = criterion(model(x_full), y_full)
+                    # Same L2 penalty as SGD's weight_decay=1e-5.
+                    loss = loss + 0.5 * 1e-5 * sum((p ** 2).sum() for p in model.parameters())
+                    loss.backward()
+                    return loss
+                with timer.phase('optimizer_step'):
+                    optimizer.step(closure)
+                step += 1
+                with torch.no_grad():
+                    loss_record.append(criterion(model(x_full), y_full).item())
+                train_pbar = []
+            else:
+                # tqdm is a package to visualize your training progress.
+                train_pbar = tqdm(train_loader, position=0, leave=True)
+
+            for x, y in timer.iterate(train_pbar, 'data_fetch'):
+                optimizer.zero_grad()               # Set gradient to zero.
+                with timer.phase('host_to_device'):
+                    x, y = x.to(device), y.to(device)   # Move your data to device. 
+                with timer.phase('forward'):
+                    pred = model(x)             
+                    loss = criterion(pred, y)
+                with timer.phase('backward'):
+                    loss.backward()                     # Compute gradient(backpropagation).
+                with timer.phase('optimizer_step'):
+                    optimizer.step()                    # Update parameters.
+                step += 1
+                with timer.phase('progress_bar'):
+                    loss_record.append(loss.detach().item())
+                
+                    # Display current epoch number and loss on tqdm progress bar.
+                    train_pbar.set_description(f'Epoch [{epoch+1}/{n_epochs}]')
+                    train_pbar.set_postfix({'loss': loss.detach().item()})
+
+            mean_train_loss = sum(loss_record)/len(loss_record)
+            writer.add_scalar('Loss/train', mean_train_loss, step)
+
+            model.eval() # Set your model to evaluation mode.
+            loss_record = []
+            with timer.phase('validation'):
+                for x, y in valid_loader:
+                    x, y = x.to(device), y.to(device)
+                    with torch.no_grad():
+                        pred = model(x)
+                        loss = criterion(pred, y)
+
+                    loss_record.append(loss.item())
             
-            # Display current epoch number and loss on tqdm progress bar.
-            train_pbar.set_description(f'Epoch [{epoch+1}/{n_epochs}]')
-            train_pbar.set_postfix({'loss': loss.detach().item()})
+            mean_valid_loss = sum(loss_record)/len(loss_record)
+            print(f'Epoch [{epoch+1}/{n_epochs}]: Train loss: {mean_train_loss:.4f}, Valid loss: {mean_valid_loss:.4f}')
+            writer.add_scalar('Loss/valid', mean_valid_loss, step)
+
+            if target_mse is not None and time_to_target is None and mean_valid_loss <= target_mse:
+                time_to_target = time.perf_counter() - start_time
+                print(f'Reached valid loss {target_mse} after {time_to_target:.2f}s ({epoch+1} epochs)')
+
+            if mean_valid_loss < best_loss:
+                best_loss = mean_valid_loss
+                with timer.phase('checkpoint_save'):
+                    ckpt_writer.save(model.state_dict(), config['save_path']) # Save your best model in the background
+                print('Saving model with loss {:.3f}...'.format(best_loss))
+                early_stop_count = 0
+            else: 
+                early_stop_count += 1
+            timer.log(writer, step)
+
+            if early_stop_count >= config['early_stop']:
+                print('\nModel is not improving, so we halt the training session.')
+                break
+
+            if report is not None and report(epoch, mean_valid_loss):
+                print('\nModel is pruned by the sweep, so we halt the training session.')
+                break
+    finally:
+        ckpt_writer.close() # Wait for the last best model to be on disk, also when training fails or is interrupted.
+
+    if target_mse is not None:
+        mode = config.get('optimizer', 'sgd') + ('' if config.get('ridge_alpha') is None else ' + ridge warm start')
+        reached = 'not reached' if time_to_target is None else f'{time_to_target:.2f}s'
+        print(f'[{mode}] time to valid loss {target_mse}: {reached}, best valid loss {best_loss:.4f} in {time.perf_counter() - start_time:.2f}s')
+    return best_loss
+
+def ensemble_trainer(train_dataset, valid_dataset, input_dim, config, device):
+    '''
+    Trains one My_Model per seed in config['ensemble_seeds'] together as an Ensemble_Model.
+    Every replica keeps its own learning rate, SGD momentum buffer, early stop counter and best weights.
+    The best replicas are saved next to config['save_path'], and the overall best one to config['save_path'] itself.
+    '''
+    seeds = config['ensemble_seeds']
+    lrs = config.get('ensemble_lrs') or [config['learning_rate']] * len(seeds)
+    momentum, weight_decay = config.get('momentum', 0.8), 1e-5 # Same as trainer.
+    n_models = len(seeds)
+
+    models = []
+    for seed in seeds:
+        torch.manual_seed(seed) # Same initialization as a single run with same_seed(seed).
+        models.append(My_Model(input_dim=input_dim))
+    model = Ensemble_Model(models).to(device)
+    del models
+
+    x_train, y_train = train_dataset.x.to(device), train_dataset.y.to(device)
+    x_valid, y_valid = valid_dataset.x.to(device), valid_dataset.y.to(device)
+    n_train, batch_size = len(x_train), config['batch_size']
+    generator = torch.Generator().manual_seed(config['seed'])
+
+    lr = torch.tensor(lrs, dtype=torch.float32, device=device)
+    momentum_buffer = [None] * len(list(model.parameters()))
+    best_params = [p.detach().clone() for p in model.parameters()]
+
+    writer = SummaryWriter() # Writer of tensoboard.
 
-        mean_train_loss = sum(loss_record)/len(loss_record)
-        writer.add_scalar('Loss/train', mean_train_loss, step)
+    if not os.path.isdir('./models'):
+        os.mkdir('./models') # Create directory of saving models.
 
-        model.eval() # Set your model to evaluation mode.
-        loss_record = []
-        for x, y in valid_loader:
-            x, y = x.to(device), y.to(device)
+    n_epochs, step = config['n_epochs'], 0
+    best_loss = torch.full((n_models,), math.inf, device=device)
+    early_stop_count = torch.zeros(n_models, dtype=torch.long, device=device)
+    active = torch.ones(n_models, dtype=torch.bool, device=device)
+
+    for epoch in range(n_epochs):
+        model.train()
+        # Every replica gets its own shuffle of the training set.
+        order = torch.argsort(torch.rand(n_models, n_train, generator=generator), dim=1).to(device)
+        train_loss, n_batches = torch.zeros(n_models, device=device), 0
+
+        for start in range(0, n_train, batch_size):
+            idx = order[:, start: start + batch_size]
+            x, y = x_train[idx], y_train[idx] # (K, B, input_dim), (K, B)
+            pred = model(x)
+            loss = ((pred - y) ** 2).mean(dim=1) # MSE of every replica.
+            model.zero_grad()
+            loss.sum().backward() # Replicas do not share parameters, so each gets the gradient of its own loss.
+
+            # SGD with momentum and weight decay, as torch.optim.SGD, with one learning rate per replica.
             with torch.no_grad():
-                pred = model(x)
-                loss = criterion(pred, y)
+                step_lr = lr * active
+                for i, p in enumerate(model.parameters()):
+                    d_p = p.grad.add(p, alpha=weight_decay)
+                    if momentum_buffer[i] is None:
+                        momentum_buffer[i] = d_p.clone()
+                    else:
+                        momentum_buffer[i].mul_(momentum).add_(d_p)
+                    p.sub_(step_lr.view(-1, *[1] * (p.dim() - 1)) * momentum_buffer[i])
+
+            train_loss += loss.detach()
+            n_batches += 1
+            step += 1
 
-            loss_record.append(loss.item())
-            
-        mean_valid_loss = sum(loss_record)/len(loss_record)
-        print(f'Epoch [{epoch+1}/{n_epochs}]: Train loss: {mean_train_loss:.4f}, Valid loss: {mean_valid_loss:.4f}')
-        writer.add_scalar('Loss/valid', mean_valid_loss, step)
-
-        if mean_valid_loss < best_loss:
-            best_loss = mean_valid_loss
-            torch.save(model.state_dict(), config['save_path']) # Save your best model
-            print('Saving model with loss {:.3f}...'.format(best_loss))
-            early_stop_count = 0
-        else: 
-            early_stop_count += 1
-
-        if early_stop_count >= config['early_stop']:
-            print('\nModel is not improving, so we halt the training session.')
-            return
+        mean_train_loss = train_loss / n_batches
+
+        model.eval()
+        valid_loss, n_batches = torch.zeros(n_models, device=device), 0
+        with torch.no_grad():
+            for start in range(0, len(x_valid), batch_size):
+                x, y = x_valid[start: start + batch_size], y_valid[start: start + batch_size]
+                pred = model(x.expand(n_models, -1, -1))
+                valid_loss += ((pred - y) ** 2).mean(dim=1)
+                n_batches += 1
+        mean_valid_loss = valid_loss / n_batches
+
+        for k, seed in enumerate(seeds):
+            writer.add_scalar(f'Loss/train/{seed}', mean_train_loss[k].item(), step)
+            writer.add_scalar(f'Loss/valid/{seed}', mean_valid_loss[k].item(), step)
+
+        improved = (mean_valid_loss < best_loss) & active
+        best_loss = torch.where(improved, mean_valid_loss, best_loss)
+        with torch.no_grad():
+            for best, p in zip(best_params, model.parameters()):
+                best[improved] = p[improved]
+        early_stop_count = torch.where(improved, torch.zeros_like(early_stop_count), early_stop_count + 1)
+        active &= early_stop_count < config['early_stop']
+
+        print(f'Epoch [{epoch+1}/{n_epochs}]: Best valid loss: {best_loss.min().item():.4f}, Active models: {int(active.sum().item())}/{n_models}')
+        if not active.any():
+            print('\nNo model is improving, so we halt the training session.')
+            break
+
+    with torch.no_grad():
+        for best, p in zip(best_params, model.parameters()):
+            p.copy_(best)
+
+    root, ext = os.path.splitext(config['save_path'])
+    for k, (seed, lr_k) in enumerate(zip(seeds, lrs)):
+        torch.save(model.replica_state_dict(k), f'{root}_seed{seed}_lr{lr_k}{ext}')
+        print(f'seed {seed}, lr {lr_k}: best valid loss {best_loss[k].item():.4f}')
+    best_k = int(best_loss.argmin().item())
+    torch.save(model.replica_state_dict(best_k), config['save_path'])
+    print('Saving model of seed {} with loss {:.3f}...'.format(seeds[best_k], best_loss[best_k].item()))
+
+    return best_loss.cpu()
 
 def vaccine(data):
-    data_vaccine = []
-    for index in range(len(data)):
-        count = False
-        for i in range(1, 37):
-            if(int(data[index][i]) == 1):
-                data_vaccine.append(i)
-                count = True
-                break
-        if(count == False):data_vaccine.append(0)
+    '''
+    Prepends the index (1-36) of the one-hot state column of every row, 0 if no state is set.
+    Works for train, valid and test data since the state block is columns 1-36 in all of them.
+    '''
+    states = data[:, 1:37].astype(np.int64) == 1 # int() of every cell, as the state columns are 0/1.
+    # argmax returns the first matching column, 0 for rows without any state, so those are masked to 0.
+    data_vaccine = np.where(states.any(axis=1), states.argmax(axis=1) + 1, 0)
 
-    data_vaccine = np.insert(data, 0, data_vaccine, axis = 1)
+    # Allocate the output once instead of np.insert, which copies the whole matrix again.
+    # Keep the dtype of data (float32 from read_csv_cached), the state indices are small integers.
+    out = np.empty((data.shape[0], data.shape[1] + 1), dtype=data.dtype)
+    out[:, 0] = data_vaccine
+    out[:, 1:] = data
 
-    return data_vaccine
+    return out
+
+
+def save_pred(preds, file):
+    ''' Save predictions to specified file '''
+    with open(file, 'w') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['id', 'tested_positive'])
+        for i, p in enumerate(preds):
+            writer.writerow([i, p])
 
 
 # Configurations
@@ -258,72 +721,86 @@ config = {
     'batch_size': 512, 
     'learning_rate': 1e-4,              
     'early_stop': 400,    # If model has not improved for this many consecutive epochs, stop training.     
-    'save_path': './models/model.ckpt'  # Your model will be saved here.
+    'save_path': './models/model.ckpt',  # Your model will be saved here.
+    'cache_dir': './cache',   # Where the float32 .npy snapshots of the csv files are kept.
+    'optimizer': 'sgd',       # 'sgd' or 'lbfgs_fullbatch' (one L-BFGS step over the whole training set per epoch).
+    'ridge_alpha': None,      # If set, report a ridge regression baseline and warm start the output layer in closed form.
+    'target_mse': None,       # If set, report the time it takes to reach this validation loss.
+    'profile': False,         # Log the time of every training phase and the peak RSS to tensorboard.
+    'ensemble_seeds': None,   # e.g. list(range(32)), train one model per seed together in a single batched model.
+    'ensemble_lrs': None,     # Learning rate of every ensemble seed, None uses 'learning_rate' for all of them.
 }
 
-# Dataloader
+if __name__ == '__main__':
+    # Dataloader
+
+    # Set seed for reproducibility
+    same_seed(config['seed'])
 
-# Set seed for reproducibility
-same_seed(config['seed'])
 
+    # train_data size: 2699 x 118 (id + 37 states + 16 features x 5 days) 
+    # test_data size: 1078 x 117 (without last day's positive rate)
+    # train_data, test_data = pd.read_csv('./covid.train.csv').values, pd.read_csv('./covid.test.csv').values
 
-# train_data size: 2699 x 118 (id + 37 states + 16 features x 5 days) 
-# test_data size: 1078 x 117 (without last day's positive rate)
-train_data, test_data = pd.read_csv('./covid.train.csv').values, pd.read_csv('./covid.test.csv').values
+    # Only read the selected features (and the target) as float32, and cache them as memory-mapped .npy.
+    n_columns = len(pd.read_csv('./covid.train.csv', nrows=0).columns)
+    feat_idx = select_feat_idx(n_columns - 1, config['select_all'])
+    train_data = read_csv_cached('./covid.train.csv', feat_idx + [n_columns - 1], config['cache_dir'])
+    test_data = read_csv_cached('./covid.test.csv', feat_idx, config['cache_dir'])
 
-train_data, valid_data = train_valid_split(train_data, config['valid_ratio'], config['seed'])
+    train_data, valid_data = train_valid_split(train_data, config['valid_ratio'], config['seed'])
 
-# train_vaccine = vaccine(train_data)
-# valid_vaccine = vaccine(valid_data)
+    # train_vaccine = vaccine(train_data)
+    # valid_vaccine = vaccine(valid_data)
 
 
-# Print out the data size.
-print(f"""train_data size: {train_data.shape} 
+    # Print out the data size.
+    print(f"""train_data size: {train_data.shape} 
 valid_data size: {valid_data.shape} 
 test_data size: {test_data.shape}""")
 
-# Select features
-x_train, x_valid, x_test, y_train, y_valid = select_feat(train_data, valid_data, test_data, config['select_all'])
+    # Select features, the csv columns were already pruned to feat_idx so every remaining one is kept.
+    x_train, x_valid, x_test, y_train, y_valid = select_feat(train_data, valid_data, test_data, select_all=True)
 
 
 
 
 
-# Print out the number of features.
-print(f'number of features: {x_train.shape[1]}')
+    # Print out the number of features.
+    print(f'number of features: {x_train.shape[1]}')
 
-train_dataset, valid_dataset, test_dataset = COVID19Dataset(x_train, y_train), \
-                                            COVID19Dataset(x_valid, y_valid), \
-                                            COVID19Dataset(x_test)
+    train_dataset, valid_dataset, test_dataset = COVID19Dataset(x_train, y_train), \
+                                                COVID19Dataset(x_valid, y_valid), \
+                                                COVID19Dataset(x_test)
 
 
 
-# Pytorch data loader loads pytorch dataset into batches.
-train_loader = DataLoader(train_dataset, batch_size=config['batch_size'], shuffle=True, pin_memory=True)
-valid_loader = DataLoader(valid_dataset, batch_size=config['batch_size'], shuffle=True, pin_memory=True)
-test_loader = DataLoader(test_dataset, batch_size=config['batch_size'], shuffle=False, pin_memory=True)
+    # Pytorch data loader loads pytorch dataset into batches.
+    # train_loader = DataLoader(train_dataset, batch_size=config['batch_size'], shuffle=True, pin_memory=True)
+    # valid_loader = DataLoader(valid_dataset, batch_size=config['batch_size'], shuffle=True, pin_memory=True)
+    # test_loader = DataLoader(test_dataset, batch_size=config['batch_size'], shuffle=False, pin_memory=True)
 
+    # The whole dataset fits in memory, so slice the resident tensors instead of collating row by row.
+    train_loader = TensorBatchLoader(train_dataset, batch_size=config['batch_size'], shuffle=True, device=device)
+    valid_loader = TensorBatchLoader(valid_dataset, batch_size=config['batch_size'], shuffle=True, device=device)
+    test_loader = TensorBatchLoader(test_dataset, batch_size=config['batch_size'], shuffle=False, device=device)
 
 
 
-# Start training!
-model = My_Model(input_dim=x_train.shape[1]).to(device) # put your model and data on the same computation device.
-trainer(train_loader, valid_loader, model, config, device)
 
+    # Start training!
+    if config['ensemble_seeds']:
+        ensemble_trainer(train_dataset, valid_dataset, x_train.shape[1], config, device)
+    else:
+        model = My_Model(input_dim=x_train.shape[1]).to(device) # put your model and data on the same computation device.
+        trainer(train_loader, valid_loader, model, config, device)
 
-# Testing
 
-def save_pred(preds, file):
-    ''' Save predictions to specified file '''
-    with open(file, 'w') as fp:
-        writer = csv.writer(fp)
-        writer.writerow(['id', 'tested_positive'])
-        for i, p in enumerate(preds):
-            writer.writerow([i, p])
+    # Testing
 
-model = My_Model(input_dim=x_train.shape[1]).to(device)
-model.load_state_dict(torch.load(config['save_path']))
-preds = predict(test_loader, model, device) 
-save_pred(preds, 'pred.csv')  
+    model = My_Model(input_dim=x_train.shape[1]).to(device)
+    model.load_state_dict(torch.load(config['save_path']))
+    preds = predict(test_loader, model, device) 
+    save_pred(preds, 'pred.csv')  
 
-print('Using device:', device)
\ No newline at end of file
+    print('Using device:', device)
\ No newline at end of file
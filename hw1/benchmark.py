@@ -0,0 +1,35 @@
+# Micro benchmarks for the HW1 pipeline.
+# Run from the hw1 directory: python benchmark.py
+
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from HW1 import COVID19Dataset, TensorBatchLoader, same_seed, config
+
+
+def epochs_per_sec(loader, n_epochs):
+    '''Iterates over loader for n_epochs and returns the number of epochs per second.'''
+    start = time.perf_counter()
+    for _ in range(n_epochs):
+        for x, y in loader:
+            pass
+    return n_epochs / (time.perf_counter() - start)
+
+
+def bench_loader(n_rows=2160, n_feat=24, n_epochs=200):
+    '''DataLoader vs TensorBatchLoader over a dataset the size of the COVID train split.'''
+    same_seed(config['seed'])
+    dataset = COVID19Dataset(torch.randn(n_rows, n_feat).numpy(), torch.randn(n_rows).numpy())
+
+    dataloader = DataLoader(dataset, batch_size=config['batch_size'], shuffle=True)
+    tensorloader = TensorBatchLoader(dataset, batch_size=config['batch_size'], shuffle=True)
+
+    before = epochs_per_sec(dataloader, n_epochs)
+    after = epochs_per_sec(tensorloader, n_epochs)
+    print(f'[loader] rows: {n_rows}, DataLoader: {before:.1f} epochs/s, TensorBatchLoader: {after:.1f} epochs/s ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    bench_loader()
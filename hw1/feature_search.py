@@ -0,0 +1,158 @@
+# Feature selection search for select_feat.
+# Scores feature subsets with a closed-form ridge proxy instead of a full trainer run.
+# Run from the hw1 directory: python feature_search.py
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from HW1 import read_csv_cached, train_valid_split, config
+
+
+class RidgeProxy:
+    '''
+    Validation MSE of a ridge regression on a subset of the standardized features.
+    X^T X and X^T y are computed once for all columns, so a subset is scored without another pass over the data,
+    and adding or dropping one feature updates the inverse of the subset's Gram matrix with a rank-1 formula.
+    '''
+    def __init__(self, x_train, y_train, x_valid, y_valid, alpha=1.0):
+        x_train, x_valid = x_train.astype(np.float64), x_valid.astype(np.float64)
+        mean, std = x_train.mean(axis=0), x_train.std(axis=0)
+        std[std == 0] = 1
+        x_train, x_valid = (x_train - mean) / std, (x_valid - mean) / std
+        y_mean = y_train.mean()
+        y_train, y_valid = y_train - y_mean, y_valid - y_mean
+
+        self.alpha = alpha
+        self.G, self.b = x_train.T @ x_train, x_train.T @ y_train # train Gram
+        self.H, self.c = x_valid.T @ x_valid, x_valid.T @ y_valid # valid Gram
+        self.yy, self.n_valid = y_valid @ y_valid, len(y_valid)
+
+    def inverse(self, feat_idx):
+        '''(G_SS + alpha * I)^-1 of the subset'''
+        return np.linalg.inv(self.G[np.ix_(feat_idx, feat_idx)] + self.alpha * np.eye(len(feat_idx)))
+
+    def score(self, feat_idx, inv=None):
+        '''Validation MSE of the ridge fit on feat_idx'''
+        if len(feat_idx) == 0:
+            return self.yy / self.n_valid
+        if inv is None:
+            inv = self.inverse(feat_idx)
+        w = inv @ self.b[feat_idx]
+        # ||y - X w||^2 = y^T y - 2 w^T X^T y + w^T X^T X w, all from the cached valid Gram.
+        return (self.yy - 2 * w @ self.c[feat_idx] + w @ self.H[np.ix_(feat_idx, feat_idx)] @ w) / self.n_valid
+
+    def add_inverse(self, feat_idx, inv, j):
+        '''Inverse after appending feature j to feat_idx (block inverse with the Schur complement)'''
+        if len(feat_idx) == 0:
+            return np.array([[1 / (self.G[j, j] + self.alpha)]])
+        u = self.G[feat_idx, j]
+        v = inv @ u
+        s = self.G[j, j] + self.alpha - u @ v
+        n = len(feat_idx)
+        out = np.empty((n + 1, n + 1))
+        out[:n, :n] = inv + np.outer(v, v) / s
+        out[:n, n] = out[n, :n] = -v / s
+        out[n, n] = 1 / s
+        return out
+
+    def drop_inverse(self, inv, pos):
+        '''Inverse after removing the feature at position pos of feat_idx'''
+        keep = np.arange(len(inv)) != pos
+        f = inv[keep, pos]
+        return inv[np.ix_(keep, keep)] - np.outer(f, f) / inv[pos, pos]
+
+
+# Every worker process builds its proxy once, then only feature indices travel between processes.
+_proxy = None
+
+def _init_worker(proxy):
+    global _proxy
+    _proxy = proxy
+
+def _score_subset(feat_idx):
+    return _proxy.score(list(feat_idx))
+
+def _score_moves(args):
+    '''Scores adding every feature of candidates to feat_idx, and dropping every feature of feat_idx.'''
+    feat_idx, inv, candidates, drop = args
+    scores = []
+    for j in candidates:
+        scores.append((_proxy.score(feat_idx + [j], _proxy.add_inverse(feat_idx, inv, j)), 'add', j))
+    for pos in drop:
+        scores.append((_proxy.score(feat_idx[:pos] + feat_idx[pos+1:], _proxy.drop_inverse(inv, pos)), 'drop', feat_idx[pos]))
+    return scores
+
+
+def stepwise_search(proxy, candidates, start=(), max_features=None, n_workers=None):
+    '''
+    Greedy forward/backward search: every step takes the best single add or drop, until no move improves the score.
+    The moves of a step are scored in parallel across a process pool.
+    '''
+    feat_idx = list(start)
+    inv = proxy.inverse(feat_idx) if feat_idx else np.empty((0, 0))
+    best = proxy.score(feat_idx, inv)
+    max_features = max_features or len(candidates)
+    n_scored = 0
+
+    n_chunks = n_workers or os.cpu_count()
+    with ProcessPoolExecutor(n_chunks, initializer=_init_worker, initargs=(proxy,)) as pool:
+        while True:
+            rest = [j for j in candidates if j not in feat_idx] if len(feat_idx) < max_features else []
+            drop = list(range(len(feat_idx)))
+            jobs = [(feat_idx, inv, rest[i::n_chunks], drop[i::n_chunks]) for i in range(n_chunks)]
+            moves = [move for scores in pool.map(_score_moves, jobs) for move in scores]
+            n_scored += len(moves)
+            if not moves:
+                break
+            score, move, j = min(moves, key=lambda m: m[0])
+            if score >= best:
+                break
+            best = score
+            if move == 'add':
+                inv = proxy.add_inverse(feat_idx, inv, j)
+                feat_idx.append(j)
+            else:
+                pos = feat_idx.index(j)
+                inv = proxy.drop_inverse(inv, pos)
+                feat_idx.pop(pos)
+            print(f'[{move} {j}] features: {len(feat_idx)}, valid MSE: {best:.4f}')
+
+    return sorted(feat_idx), best, n_scored
+
+
+def score_subsets(proxy, subsets, n_workers=None):
+    '''Validation MSE of every subset, scored in parallel'''
+    with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(proxy,)) as pool:
+        return list(pool.map(_score_subset, subsets, chunksize=16))
+
+
+search_config = {
+    'alpha': 1.0,             # Ridge regularization of the proxy.
+    'max_features': 40,       # Upper bound of the number of selected features.
+    'n_workers': None,        # Size of the process pool, None uses every cpu.
+    'n_random': 500,          # Number of random subsets scored as a reference.
+}
+
+if __name__ == '__main__':
+    start_time = time.perf_counter()
+
+    train_data = read_csv_cached('./covid.train.csv', cache_dir=config['cache_dir'])
+    train_data, valid_data = train_valid_split(np.asarray(train_data), config['valid_ratio'], config['seed'])
+    x_train, y_train = train_data[:, :-1], train_data[:, -1]
+    x_valid, y_valid = valid_data[:, :-1], valid_data[:, -1]
+    proxy = RidgeProxy(x_train, y_train, x_valid, y_valid, search_config['alpha'])
+
+    # Column 0 is the id, every other column of the csv (without the target) is a candidate.
+    candidates = list(range(1, x_train.shape[1]))
+
+    rng = np.random.default_rng(config['seed'])
+    subsets = [sorted(rng.choice(candidates, size=rng.integers(1, search_config['max_features'] + 1), replace=False)) for _ in range(search_config['n_random'])]
+    scores = score_subsets(proxy, subsets, search_config['n_workers'])
+    print(f'Best of {len(subsets)} random subsets: valid MSE {min(scores):.4f}')
+
+    feat_idx, best, n_scored = stepwise_search(proxy, candidates, max_features=search_config['max_features'], n_workers=search_config['n_workers'])
+    print(f'Stepwise search scored {n_scored} subsets, valid MSE {best:.4f}, in {time.perf_counter() - start_time:.2f}s')
+    print(f'feat_idx = {feat_idx}')
@@ -0,0 +1,98 @@
+# CPU inference for the HW1 regressor.
+# Exports the trained My_Model with the select_feat gather baked in, scores a csv in large chunks,
+# and reports the throughput and the latency of single-row requests.
+# Run from the hw1 directory after training: python inference.py
+
+import io
+import time
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn as nn
+
+from HW1 import My_Model, select_feat_idx, config
+
+
+class SelectedFeatureModel(nn.Module):
+    '''
+    My_Model that takes a raw csv row (without the target) and gathers its selected features itself.
+    x: (B, n_columns) -> (B)
+    '''
+    def __init__(self, model, feat_idx):
+        super(SelectedFeatureModel, self).__init__()
+        self.model = model
+        self.register_buffer('feat_idx', torch.tensor(feat_idx, dtype=torch.long))
+
+    def forward(self, x):
+        return self.model(x.index_select(1, self.feat_idx))
+
+
+def export(model_path, n_columns, export_path, onnx_path=None):
+    '''Saves a TorchScript (and optionally ONNX) model of the checkpoint at model_path.'''
+    feat_idx = select_feat_idx(n_columns, config['select_all'])
+    model = My_Model(input_dim=len(feat_idx))
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    model = SelectedFeatureModel(model, feat_idx).eval()
+
+    scripted = torch.jit.script(model)
+    scripted = torch.jit.freeze(scripted)
+    scripted.save(export_path)
+    print(f'TorchScript model saved to {export_path}')
+
+    if onnx_path is not None:
+        torch.onnx.export(model, torch.zeros(1, n_columns), onnx_path, input_names=['x'], output_names=['y'],
+                          dynamic_axes={'x': {0: 'batch'}, 'y': {0: 'batch'}})
+        print(f'ONNX model saved to {onnx_path}')
+    return scripted
+
+
+def bulk_predict(model, csv_path, pred_path, chunk_size=65536):
+    '''
+    Scores csv_path chunk by chunk with one forward pass each, and writes every chunk of pred_path with a single write.
+    Returns the number of rows and the rows per second.
+    '''
+    n_rows, start = 0, time.perf_counter()
+    with open(pred_path, 'w') as fp, torch.inference_mode():
+        fp.write('id,tested_positive\n')
+        for chunk in pd.read_csv(csv_path, dtype=np.float32, chunksize=chunk_size):
+            preds = model(torch.from_numpy(chunk.to_numpy())).numpy()
+            ids = np.arange(n_rows, n_rows + len(preds))
+
+            buffer = io.StringIO()
+            np.savetxt(buffer, np.column_stack((ids, preds)), fmt=['%d', '%.7g'], delimiter=',')
+            fp.write(buffer.getvalue())
+            n_rows += len(preds)
+    return n_rows, n_rows / (time.perf_counter() - start)
+
+
+def single_row_latency(model, n_columns, n_requests=2000, n_warmup=100):
+    '''p50 and p99 latency in ms of scoring one row per call.'''
+    x = torch.randn(1, n_columns)
+    latency = []
+    with torch.inference_mode():
+        for i in range(n_warmup + n_requests):
+            start = time.perf_counter()
+            model(x)
+            if i >= n_warmup:
+                latency.append(time.perf_counter() - start)
+    return np.percentile(latency, 50) * 1e3, np.percentile(latency, 99) * 1e3
+
+
+infer_config = {
+    'test_path': './covid.test.csv',
+    'export_path': './models/model.pt',
+    'onnx_path': None,          # e.g. './models/model.onnx', also export an ONNX model.
+    'pred_path': './pred.csv',
+    'chunk_size': 65536,        # Rows scored per forward pass.
+}
+
+if __name__ == '__main__':
+    n_columns = len(pd.read_csv(infer_config['test_path'], nrows=0).columns)
+    model = export(config['save_path'], n_columns, infer_config['export_path'], infer_config['onnx_path'])
+
+    n_rows, rows_per_sec = bulk_predict(model, infer_config['test_path'], infer_config['pred_path'], infer_config['chunk_size'])
+    print(f'[bulk] {n_rows} rows, {rows_per_sec:.0f} rows/s, predictions saved to {infer_config["pred_path"]}')
+
+    p50, p99 = single_row_latency(model, n_columns)
+    print(f'[single row] p50: {p50:.3f} ms, p99: {p99:.3f} ms')
@@ -0,0 +1,115 @@
+# Hyperparameter sweep over the HW1 config.
+# Trials run in a process pool and losers are pruned with asynchronous successive halving (ASHA)
+# on the per-epoch validation loss reported by trainer.
+# Run from the hw1 directory: python sweep.py
+
+import os
+import time
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+
+from HW1 import COVID19Dataset, TensorBatchLoader, My_Model, read_csv_cached, select_feat_idx, train_valid_split, \
+    trainer, same_seed, config
+
+
+class ASHA:
+    '''
+    Asynchronous successive halving: rungs are at min_epochs * eta^k epochs.
+    A trial reaching a rung is stopped unless its validation loss is in the best 1/eta of
+    the losses recorded at that rung so far, so no trial ever waits for the others.
+    '''
+    def __init__(self, rungs, lock, min_epochs, eta, max_epochs):
+        self.rungs, self.lock, self.eta = rungs, lock, eta
+        self.milestones = []
+        epochs = min_epochs
+        while epochs < max_epochs:
+            self.milestones.append(epochs)
+            epochs *= eta
+
+    def __call__(self, epoch, loss):
+        epoch += 1
+        if epoch not in self.milestones:
+            return False
+        with self.lock:
+            losses = self.rungs.get(epoch, []) + [loss]
+            self.rungs[epoch] = losses
+        return loss > np.percentile(losses, 100 / self.eta)
+
+
+# Every worker builds the data once, pins its thread count, then trains one trial after another.
+_worker = {}
+
+def _init_worker(n_threads, rungs, lock):
+    torch.set_num_threads(n_threads)
+
+    n_columns = len(pd.read_csv('./covid.train.csv', nrows=0).columns)
+    feat_idx = select_feat_idx(n_columns - 1, config['select_all'])
+    train_data = read_csv_cached('./covid.train.csv', feat_idx + [n_columns - 1], config['cache_dir'])
+    train_data, valid_data = train_valid_split(train_data, config['valid_ratio'], config['seed'])
+
+    _worker['train_dataset'] = COVID19Dataset(train_data[:, :-1], train_data[:, -1])
+    _worker['valid_dataset'] = COVID19Dataset(valid_data[:, :-1], valid_data[:, -1])
+    _worker['rungs'], _worker['lock'] = rungs, lock
+
+def _run_trial(args):
+    trial, params, sweep_config = args
+    trial_config = dict(config, **params)
+    trial_config['save_path'] = os.path.join(sweep_config['save_dir'], f'trial_{trial}.ckpt')
+    same_seed(trial_config['seed'])
+
+    train_loader = TensorBatchLoader(_worker['train_dataset'], batch_size=trial_config['batch_size'], shuffle=True)
+    valid_loader = TensorBatchLoader(_worker['valid_dataset'], batch_size=trial_config['batch_size'], shuffle=True)
+    model = My_Model(input_dim=_worker['train_dataset'].x.shape[1], widths=trial_config.get('widths', (512, 256, 64, 32)))
+
+    epochs, pruned = [], []
+    asha = ASHA(_worker['rungs'], _worker['lock'], sweep_config['min_epochs'], sweep_config['eta'], trial_config['n_epochs'])
+    def report(epoch, loss):
+        epochs.append(epoch)
+        if asha(epoch, loss):
+            pruned.append(epoch)
+            return True
+        return False
+
+    start = time.perf_counter()
+    best_loss = trainer(train_loader, valid_loader, model, trial_config, 'cpu', report=report)
+    return dict(trial=trial, **params, best_loss=best_loss, epochs=len(epochs), pruned=bool(pruned), seconds=time.perf_counter() - start)
+
+
+sweep_config = {
+    'search_space': {
+        'learning_rate': [1e-5, 3e-5, 1e-4, 3e-4, 1e-3],
+        'batch_size': [64, 128, 256, 512],
+        'momentum': [0.5, 0.8, 0.9, 0.95],
+        'widths': [(512, 256, 64, 32), (256, 128, 32), (128, 64), (64, 32, 16)],
+    },
+    'n_trials': 64,             # Number of random configurations to try.
+    'n_workers': 8,             # Number of trials running at the same time.
+    'min_epochs': 50,           # First ASHA rung.
+    'eta': 3,                   # Only the best 1/eta of the trials continue past each rung.
+    'save_dir': './models/sweep',
+    'results_path': './sweep.csv',
+}
+
+if __name__ == '__main__':
+    os.makedirs(sweep_config['save_dir'], exist_ok=True)
+    rng = random.Random(config['seed'])
+    trials = [(i, {k: rng.choice(v) for k, v in sweep_config['search_space'].items()}, sweep_config) for i in range(sweep_config['n_trials'])]
+
+    # Split the cores between the workers so the trials do not oversubscribe them.
+    n_threads = max(1, os.cpu_count() // sweep_config['n_workers'])
+    manager = multiprocessing.Manager()
+    rungs, lock = manager.dict(), manager.Lock()
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(sweep_config['n_workers'], initializer=_init_worker, initargs=(n_threads, rungs, lock)) as pool:
+        results = list(pool.map(_run_trial, trials))
+
+    results = pd.DataFrame(results).sort_values('best_loss')
+    results.to_csv(sweep_config['results_path'], index=False)
+    print(results.to_string(index=False))
+    print(f'{len(results)} trials in {time.perf_counter() - start:.1f}s, results saved to {sweep_config["results_path"]}')
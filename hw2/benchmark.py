@@ -0,0 +1,273 @@
+# Checks and micro benchmarks for the HW2 pipeline.
+# Run from the hw2 directory: python benchmark.py
+
+import time
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+from hw2 import concat_feat, Classifier, input_dim, hidden_layers, hidden_dim
+from common import MetricAccumulator, FocalLoss # importing hw2 put the repository root on sys.path
+
+
+def shift(x, n):
+    if n < 0:
+        left = x[0].repeat(-n, 1)
+        right = x[:n]
+
+    elif n > 0:
+        right = x[-1].repeat(n, 1)
+        left = x[n:]
+    else:
+        return x
+
+    return torch.cat((left, right), dim=0)
+
+def concat_feat_reference(x, concat_n):
+    '''The original repeat + shift implementation of concat_feat.'''
+    assert concat_n % 2 == 1 # n must be odd
+    if concat_n < 2:
+        return x
+    seq_len, feature_dim = x.size(0), x.size(1)
+    x = x.repeat(1, concat_n)
+    x = x.view(seq_len, concat_n, feature_dim).permute(1, 0, 2) # concat_n, seq_len, feature_dim
+    mid = (concat_n // 2)
+    for r_idx in range(1, mid+1):
+        x[mid + r_idx, :] = shift(x[mid + r_idx], r_idx)
+        x[mid - r_idx, :] = shift(x[mid - r_idx], -r_idx)
+
+    return x.permute(1, 0, 2).view(seq_len, concat_n * feature_dim)
+
+
+def check_concat_feat(n_cases=500, seed=0):
+    '''concat_feat must equal the reference for random lengths and window sizes.'''
+    generator = torch.Generator().manual_seed(seed)
+    for _ in range(n_cases):
+        # The reference only handles utterances of at least concat_n // 2 frames.
+        seq_len = int(torch.randint(16, 400, (1,), generator=generator))
+        concat_n = 2 * int(torch.randint(0, 16, (1,), generator=generator)) + 1
+        x = torch.randn(seq_len, 39, generator=generator)
+        expected = concat_feat_reference(x.clone(), concat_n)
+        assert torch.equal(concat_feat(x, concat_n), expected), f'concat_feat differs for seq_len={seq_len}, concat_n={concat_n}'
+    print(f'[concat_feat] {n_cases} random cases match the reference')
+
+
+def bench(fn, *args, n_iters=200):
+    '''Seconds per call of fn(*args).'''
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(n_iters):
+        fn(*args)
+    return (time.perf_counter() - start) / n_iters
+
+
+def bench_concat_feat(concat_n=21):
+    '''Reference vs concat_feat (including the copy into X that preprocess_data does) over typical utterance lengths.'''
+    for seq_len in (200, 500, 1000, 2000):
+        x = torch.randn(seq_len, 39)
+        out = torch.empty(seq_len, 39 * concat_n)
+        before = bench(lambda: out.copy_(concat_feat_reference(x, concat_n)))
+        after = bench(lambda: out.copy_(concat_feat(x, concat_n)))
+        print(f'[concat_feat] frames: {seq_len}, reference: {before * 1e3:.3f} ms, strided: {after * 1e3:.3f} ms ({before / after:.1f}x)')
+
+
+def bench_metrics(batch_size=512, n_steps=200):
+    '''Training steps per second with a .item() on every batch vs the on-device MetricAccumulator.'''
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    model = Classifier(input_dim=input_dim, hidden_layers=hidden_layers, hidden_dim=hidden_dim).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    criterion = nn.CrossEntropyLoss()
+    features = torch.randn(batch_size, input_dim, device=device)
+    labels = torch.randint(0, 41, (batch_size,), device=device)
+
+    def step():
+        optimizer.zero_grad()
+        outputs = model(features)
+        loss = criterion(outputs, labels)
+        loss.backward()
+        optimizer.step()
+        return outputs, loss
+
+    def with_item():
+        acc, total = 0.0, 0.0
+        for _ in range(n_steps):
+            outputs, loss = step()
+            acc += (outputs.argmax(dim=1) == labels).sum().item()
+            total += loss.item()
+        return acc, total
+
+    def with_accumulator():
+        metrics = MetricAccumulator(device)
+        for _ in range(n_steps):
+            outputs, loss = step()
+            metrics.update(acc=(outputs.argmax(dim=1) == labels).sum(), loss=loss)
+        return metrics.compute() # the only sync
+
+    before = bench(with_item, n_iters=1) / n_steps
+    after = bench(with_accumulator, n_iters=1) / n_steps
+    print(f'[metrics] device: {device}, .item() per batch: {1 / before:.1f} steps/s, accumulator: {1 / after:.1f} steps/s ({before / after:.2f}x)')
+
+
+class FocalLossReference(nn.Module):
+    '''The FocalLoss that used to be copied into hw2.py and the hw3 models.'''
+    def __init__(self, gamma=2, alpha=None, size_average=True):
+        super(FocalLossReference, self).__init__()
+        self.gamma = gamma
+        self.alpha = alpha
+        if isinstance(alpha,(float,int)): self.alpha = torch.Tensor([alpha,1-alpha])
+        if isinstance(alpha,list): self.alpha = torch.Tensor(alpha)
+        self.size_average = size_average
+
+    def forward(self, input, target):
+        if input.dim()>2:
+            input = input.view(input.size(0),input.size(1),-1)  # N,C,H,W => N,C,H*W
+            input = input.transpose(1,2)    # N,C,H*W => N,H*W,C
+            input = input.contiguous().view(-1,input.size(2))   # N,H*W,C => N*H*W,C
+        target = target.view(-1,1)
+
+        logpt = F.log_softmax(input, dim=1)
+        logpt = logpt.gather(1,target)
+        logpt = logpt.view(-1)
+        pt = Variable(logpt.data.exp())
+
+        if self.alpha is not None:
+            if self.alpha.type()!=input.data.type():
+                self.alpha = self.alpha.type_as(input.data)
+            at = self.alpha.gather(0,target.data.view(-1))
+            logpt = logpt * Variable(at)
+
+        loss = -1 * (1-pt)**self.gamma * logpt
+        if self.size_average: return loss.mean()
+        else: return loss.sum()
+
+
+def check_focal_loss(n_cases=100, n_classes=41, seed=0):
+    '''FocalLoss must give the loss and logit gradients of the reference.'''
+    generator = torch.Generator().manual_seed(seed)
+    for case in range(n_cases):
+        n = int(torch.randint(1, 512, (1,), generator=generator))
+        gamma = [0, 1, 2, 2.5][case % 4]
+        alpha = torch.rand(n_classes, generator=generator).tolist() if case % 2 else None
+        size_average = case % 3 != 0
+        logits = (4 * torch.randn(n, n_classes, generator=generator, dtype=torch.float64)).requires_grad_()
+        target = torch.randint(0, n_classes, (n,), generator=generator)
+
+        losses, grads = [], []
+        for loss_cls in (FocalLossReference, FocalLoss):
+            criterion = loss_cls(gamma=gamma, alpha=alpha, size_average=size_average).double()
+            loss = criterion(logits, target)
+            grad, = torch.autograd.grad(loss, logits)
+            losses.append(loss)
+            grads.append(grad)
+        assert torch.allclose(losses[0], losses[1]) and torch.allclose(grads[0], grads[1]), f'FocalLoss differs for n={n}, gamma={gamma}'
+    print(f'[focal_loss] {n_cases} random cases match the reference')
+
+    if torch.cuda.is_available():
+        # alpha must follow CUDA logits even when the criterion was not moved to the GPU.
+        alpha = torch.rand(n_classes, generator=generator).tolist()
+        logits = torch.randn(256, n_classes, generator=generator).cuda().requires_grad_()
+        target = torch.randint(0, n_classes, (256,), generator=generator).cuda()
+        losses, grads = [], []
+        for loss_cls in (FocalLossReference, FocalLoss):
+            loss = loss_cls(alpha=alpha)(logits, target)
+            grad, = torch.autograd.grad(loss, logits)
+            losses.append(loss)
+            grads.append(grad)
+        assert torch.allclose(losses[0], losses[1]) and torch.allclose(grads[0], grads[1], atol=1e-6), 'FocalLoss differs for CUDA logits'
+        print('[focal_loss] alpha follows CUDA logits')
+
+
+def saved_bytes(fn):
+    '''Bytes of the tensors autograd keeps for backward while running fn().'''
+    total = 0
+    def pack(t):
+        nonlocal total
+        total += t.numel() * t.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out = fn()
+    return out, total
+
+
+def bench_focal_loss(n_classes=41):
+    '''Reference vs fused FocalLoss: memory kept for backward and forward + backward time.'''
+    alpha = torch.rand(n_classes).tolist()
+    for batch_size in (256, 1024, 4096):
+        logits = torch.randn(batch_size, n_classes, requires_grad=True)
+        target = torch.randint(0, n_classes, (batch_size,))
+        results = []
+        for criterion in (FocalLossReference(alpha=alpha), FocalLoss(alpha=alpha)):
+            _, kept = saved_bytes(lambda: criterion(logits, target))
+            seconds = bench(lambda: criterion(logits, target).backward())
+            results.append((kept, seconds))
+        (kept_ref, before), (kept, after) = results
+        print(f'[focal_loss] batch: {batch_size}, kept for backward: {kept_ref / 2**10:.0f} KB -> {kept / 2**10:.0f} KB, '
+              f'reference: {before * 1e3:.3f} ms, fused: {after * 1e3:.3f} ms ({before / after:.1f}x)')
+
+
+def check_checkpoint_blocks(batch_size=64, seed=0):
+    '''A checkpointed Classifier must give the same gradients, dropout masks included, and running statistics.'''
+    torch.manual_seed(seed)
+    model = Classifier(input_dim=39 * 5, hidden_layers=2, hidden_dim=64)
+    checkpointed = copy.deepcopy(model)
+    checkpointed.checkpoint_blocks = True
+    features = torch.randn(batch_size, 39 * 5)
+    labels = torch.randint(0, 41, (batch_size,))
+    for m in (model, checkpointed):
+        torch.manual_seed(seed + 1) # the same dropout masks in both models
+        m.train()
+        nn.CrossEntropyLoss()(m(features), labels).backward()
+
+    for (name, p), p_ckpt in zip(model.named_parameters(), checkpointed.parameters()):
+        assert torch.allclose(p.grad, p_ckpt.grad, atol=1e-6), f'gradient of {name} differs with checkpoint_blocks'
+    for (name, b), b_ckpt in zip(model.named_buffers(), checkpointed.buffers()):
+        assert torch.equal(b, b_ckpt), f'{name} differs with checkpoint_blocks'
+    print('[checkpoint_blocks] gradients and running statistics match')
+
+
+def bench_checkpoint_blocks(batch_sizes=(256, 1024, 4096), layer_counts=(2, 4)):
+    '''
+    Peak memory and training step time without and with checkpoint_blocks.
+    On the GPU the peak is the allocator peak of a step, on the CPU the activations kept for backward.
+    '''
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    criterion = nn.CrossEntropyLoss()
+    for n_layers in layer_counts:
+        for batch_size in batch_sizes:
+            features = torch.randn(batch_size, input_dim, device=device)
+            labels = torch.randint(0, 41, (batch_size,), device=device)
+            results = []
+            for checkpoint_blocks in (False, True):
+                model = Classifier(input_dim=input_dim, hidden_layers=n_layers, hidden_dim=hidden_dim, checkpoint_blocks=checkpoint_blocks).to(device)
+
+                def step():
+                    model.zero_grad()
+                    criterion(model(features), labels).backward()
+                    if device != 'cpu':
+                        torch.cuda.synchronize()
+
+                if device != 'cpu':
+                    step()
+                    torch.cuda.reset_peak_memory_stats()
+                    step()
+                    memory = torch.cuda.max_memory_allocated()
+                else:
+                    _, memory = saved_bytes(lambda: criterion(model(features), labels))
+                results.append((memory, bench(step, n_iters=5)))
+                del model
+            (mem_plain, before), (mem_ckpt, after) = results
+            print(f'[checkpoint_blocks] layers: {n_layers}, batch: {batch_size}, memory: {mem_plain / 2**20:.0f} MB -> {mem_ckpt / 2**20:.0f} MB, '
+                  f'step: {before * 1e3:.1f} ms -> {after * 1e3:.1f} ms ({after / before:.2f}x)')
+
+
+if __name__ == '__main__':
+    check_concat_feat()
+    bench_concat_feat()
+    bench_metrics()
+    check_focal_loss()
+    bench_focal_loss()
+    check_checkpoint_blocks()
+    bench_checkpoint_blocks()
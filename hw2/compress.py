@@ -0,0 +1,90 @@
+# Compression of the HW2 Classifier for CPU inference.
+# Turns model.ckpt into a dynamically int8-quantized model and an SVD low-rank model, saved as TorchScript
+# so the testing stage of hw2.py can load either one (test_model_path), and reports their size, speed and accuracy.
+# Run from the hw2 directory after training: python compress.py
+
+import os
+import time
+import copy
+
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from hw2 import Classifier, LibriWindowDataset, preprocess_raw_data, window_loader, \
+    input_dim, hidden_layers, hidden_dim, concat_nframes, train_ratio, num_workers, batch_size, model_path
+
+
+def quantize(model):
+    '''Linear weights stored as int8, activations quantized on the fly.'''
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+
+
+def low_rank(model, energy=0.9):
+    '''
+    Replaces every Linear by two thinner ones from the truncated SVD of its weight, keeping the smallest rank whose
+    singular values hold `energy` of the squared spectrum. Layers where the factorization is not smaller are kept.
+    '''
+    model = copy.deepcopy(model)
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if not isinstance(child, nn.Linear):
+                continue
+            U, S, Vh = torch.linalg.svd(child.weight.detach(), full_matrices=False)
+            rank = int((torch.cumsum(S ** 2, dim=0) / (S ** 2).sum() < energy).sum()) + 1
+            if rank * (child.in_features + child.out_features) >= child.in_features * child.out_features:
+                continue
+            first = nn.Linear(child.in_features, rank, bias=False)
+            second = nn.Linear(rank, child.out_features, bias=child.bias is not None)
+            first.weight.data.copy_(S[:rank, None] * Vh[:rank]) # (rank, in)
+            second.weight.data.copy_(U[:, :rank]) # (out, rank)
+            if child.bias is not None:
+                second.bias.data.copy_(child.bias.detach())
+            setattr(module, child_name, nn.Sequential(first, second))
+    return model
+
+
+def evaluate(model, loader, n_frames):
+    '''Accuracy and frames per second of model over loader.'''
+    correct, start = 0, time.perf_counter()
+    with torch.inference_mode():
+        for features, labels in tqdm(loader):
+            correct += (model(features).argmax(dim=1) == labels).sum().item()
+    return correct / n_frames, n_frames / (time.perf_counter() - start)
+
+
+def save_scripted(model, path):
+    '''Saves model as TorchScript and returns its size in MB.'''
+    scripted = torch.jit.trace(model, torch.randn(2, input_dim))
+    torch.jit.save(scripted, path)
+    return os.path.getsize(path) / 2**20
+
+
+compress_config = {
+    'energy': 0.9,                  # Fraction of the squared singular values kept by the low-rank model.
+    'int8_path': './model_int8.pt',
+    'low_rank_path': './model_low_rank.pt',
+    'float_path': './model_float.pt',
+}
+
+if __name__ == '__main__':
+    torch.set_grad_enabled(False)
+    model = Classifier(input_dim=input_dim, hidden_layers=hidden_layers, hidden_dim=hidden_dim)
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    model.eval()
+
+    val_X, val_offsets, val_y = preprocess_raw_data(split='val', feat_dir='./libriphone/feat', phone_path='./libriphone', train_ratio=train_ratio, num_workers=num_workers)
+    val_set = LibriWindowDataset(val_X, val_offsets, concat_nframes, val_y)
+    val_loader = window_loader(val_set, batch_size * 16, shuffle=False)
+
+    models = {
+        'float': (model, compress_config['float_path']),
+        'int8': (quantize(model), compress_config['int8_path']),
+        'low_rank': (low_rank(model, compress_config['energy']).eval(), compress_config['low_rank_path']),
+    }
+    base_acc = None
+    for name, (m, path) in models.items():
+        size = save_scripted(m, path)
+        acc, fps = evaluate(torch.jit.load(path), val_loader, len(val_set))
+        base_acc = acc if base_acc is None else base_acc
+        print(f'[{name}] size: {size:.1f} MB, {fps:.0f} frames/s, val acc: {acc:.6f} ({acc - base_acc:+.6f}), saved to {path}')
@@ -0,0 +1,117 @@
+# CPU data-parallel training of the HW2 Classifier.
+# Every process trains a DistributedDataParallel replica (gloo backend) on its shard of the frames, all of them
+# reading the same memory-mapped feature store, so the page cache holds the features once.
+# Launch N local processes from the hw2 directory: torchrun --standalone --nproc_per_node=N ddp_train.py
+
+import os
+from datetime import timedelta
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, BatchSampler, DistributedSampler
+from tqdm import tqdm
+
+from hw2 import Classifier, LibriWindowDataset, pack_feature_store, open_feature_store, store_split, same_seeds, \
+    concat_nframes, train_ratio, num_workers, seed, batch_size, num_epoch, learning_rate, model_path, \
+    input_dim, hidden_layers, hidden_dim, checkpoint_blocks
+from common import MetricAccumulator # importing hw2 put the repository root on sys.path
+
+
+def distributed_loader(dataset, batch_size, shuffle, seed):
+    '''Like window_loader, but every rank only gets its own shard of the frames.'''
+    sampler = DistributedSampler(dataset, shuffle=shuffle, seed=seed)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None), sampler
+
+
+def all_reduce_sum(*values):
+    '''Sums python numbers over every rank.'''
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t)
+    return t.tolist()
+
+
+feature_store = './libriphone/store'   # packed by rank 0 on first use
+store_timeout_hours = 4                # how long the other ranks may wait for rank 0 to pack the store
+
+if __name__ == '__main__':
+    # The default 30 minute timeout is shorter than packing the store from NFS on a first run.
+    dist.init_process_group('gloo', timeout=timedelta(hours=store_timeout_hours))
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    # Split the cores between the local processes so they do not oversubscribe them.
+    torch.set_num_threads(max(1, os.cpu_count() // int(os.environ.get('LOCAL_WORLD_SIZE', world_size))))
+    same_seeds(seed)
+
+    if rank == 0 and not os.path.exists(os.path.join(feature_store, 'train', 'index.npz')):
+        pack_feature_store('./libriphone/feat', './libriphone', feature_store, 'train', num_workers=num_workers)
+    dist.barrier() # the other ranks wait for the store
+
+    store = open_feature_store(feature_store, 'train')
+    train_X, train_offsets, train_starts, train_y = store_split(store, 'train', './libriphone', train_ratio=train_ratio)
+    val_X, val_offsets, val_starts, val_y = store_split(store, 'val', './libriphone', train_ratio=train_ratio)
+    train_set = LibriWindowDataset(train_X, train_offsets, concat_nframes, train_y, starts=train_starts)
+    val_set = LibriWindowDataset(val_X, val_offsets, concat_nframes, val_y, starts=val_starts)
+
+    train_loader, train_sampler = distributed_loader(train_set, batch_size, shuffle=True, seed=seed)
+    val_loader, _ = distributed_loader(val_set, batch_size, shuffle=False, seed=seed)
+
+    model = DistributedDataParallel(Classifier(input_dim=input_dim, hidden_layers=hidden_layers, hidden_dim=hidden_dim, checkpoint_blocks=checkpoint_blocks))
+    criterion = nn.CrossEntropyLoss()
+
+    best_acc = 0.0
+    for epoch in range(num_epoch):
+        metrics = MetricAccumulator()
+        train_sampler.set_epoch(epoch) # a different shuffle every epoch, the same on every rank
+
+        if epoch == 0:
+            optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-4)
+        elif epoch == 50:
+            optimizer = torch.optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9)
+
+        # training
+        model.train() # set the model to training mode
+        for i, batch in enumerate(tqdm(train_loader, disable=rank != 0)):
+            features, labels = batch
+
+            optimizer.zero_grad()
+            outputs = model(features)
+
+            loss = criterion(outputs, labels)
+            loss.backward() # gradients are averaged over the ranks here
+            optimizer.step()
+
+            _, train_pred = torch.max(outputs, 1) # get the index of the class with the highest probability
+            metrics.update(train_acc=(train_pred.detach() == labels).sum(), train_loss=loss)
+
+        # validation
+        model.eval() # set the model to evaluation mode
+        with torch.no_grad():
+            for i, batch in enumerate(tqdm(val_loader, disable=rank != 0)):
+                features, labels = batch
+                outputs = model(features)
+
+                loss = criterion(outputs, labels)
+
+                _, val_pred = torch.max(outputs, 1)
+                metrics.update(val_acc=(val_pred == labels).sum(), val_loss=loss)
+
+        # DistributedSampler pads the last shard with a few repeated frames, so divide by the frames actually seen.
+        totals, counts = metrics.compute(), metrics.counts
+        train_acc, train_loss, train_count, val_acc, val_loss, val_count = all_reduce_sum(
+            totals['train_acc'], totals['train_loss'], counts['train_loss'], totals['val_acc'], totals['val_loss'], counts['val_loss'])
+        n_train_seen = len(train_loader.sampler.sampler) * world_size
+        n_val_seen = len(val_loader.sampler.sampler) * world_size
+
+        if rank == 0:
+            print('[{:03d}/{:03d}] Train Acc: {:3.6f} Loss: {:3.6f} | Val Acc: {:3.6f} loss: {:3.6f}'.format(
+                epoch + 1, num_epoch, train_acc/n_train_seen, train_loss/train_count, val_acc/n_val_seen, val_loss/val_count
+            ))
+
+            # if the model improves, save a checkpoint at this epoch
+            if val_acc > best_acc:
+                best_acc = val_acc
+                torch.save(model.module.state_dict(), model_path)
+                print('saving model with acc {:.3f}'.format(best_acc/n_val_seen))
+
+    dist.destroy_process_group()
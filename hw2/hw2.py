@@ -11,48 +11,59 @@ Feel free to modify the data preprocess functions, but **do not drop any frame**
 """
 
 import os
+import sys
+import time
 import random
+import shutil
+import hashlib
+try:
+    import resource # Peak RSS, not available on Windows.
+except ImportError:
+    resource = None
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import torch
 from tqdm import tqdm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # the repository root, for the shared common package
+from common import MetricAccumulator, FocalLoss
+
 def load_feat(path):
     feat = torch.load(path)
     return feat
 
-def shift(x, n):
-    if n < 0:
-        left = x[0].repeat(-n, 1)
-        right = x[:n]
-
-    elif n > 0:
-        right = x[-1].repeat(n, 1)
-        left = x[n:]
-    else:
-        return x
-
-    return torch.cat((left, right), dim=0)
+def load_feats(paths, num_workers=8, use_processes=False):
+    '''Loads every feature file of paths, in order, over a thread (or process) pool.'''
+    if num_workers <= 1:
+        return [load_feat(path) for path in tqdm(paths)]
+    # torch.load is mostly waiting on the file system, so threads are usually enough.
+    pool_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_cls(num_workers) as pool:
+        return list(tqdm(pool.map(load_feat, paths, chunksize=16), total=len(paths)))
 
 def concat_feat(x, concat_n):
+    '''
+    Concatenates every frame with its concat_n // 2 past and future frames, repeating the first / last frame at the edges.
+    The edges are padded once and the windows are an as_strided view of the padded frames (rows of the output overlap
+    in memory), so copy it (e.g. into the preallocated X) before writing to it.
+    '''
     assert concat_n % 2 == 1 # n must be odd
     if concat_n < 2:
         return x
     seq_len, feature_dim = x.size(0), x.size(1)
-    x = x.repeat(1, concat_n) 
-    x = x.view(seq_len, concat_n, feature_dim).permute(1, 0, 2) # concat_n, seq_len, feature_dim
     mid = (concat_n // 2)
-    for r_idx in range(1, mid+1):
-        x[mid + r_idx, :] = shift(x[mid + r_idx], r_idx)
-        x[mid - r_idx, :] = shift(x[mid - r_idx], -r_idx)
-
-    return x.permute(1, 0, 2).view(seq_len, concat_n * feature_dim)
+    x = torch.cat((x[:1].expand(mid, -1), x, x[-1:].expand(mid, -1)), dim=0).contiguous() # replicate padding
+    # Frames t-mid ... t+mid are concat_n consecutive rows of the padded frames, i.e. one contiguous run of memory.
+    return x.as_strided((seq_len, concat_n * feature_dim), (feature_dim, 1))
 
-def preprocess_data(split, feat_dir, phone_path, concat_nframes, train_ratio=0.8, train_val_seed=1337):
+def load_split(split, phone_path, train_ratio=0.8, train_val_seed=1337, with_labels=True):
+    '''Returns the feature mode, the utterance ids of the split and their labels (empty for test or without with_labels).'''
     class_num = 41 # NOTE: pre-computed, should not need change
     mode = 'train' if (split == 'train' or split == 'val') else 'test'
 
     label_dict = {}
-    if mode != 'test':
+    if mode != 'test' and with_labels:
       phone_file = open(os.path.join(phone_path, f'{mode}_labels.txt')).readlines()
 
       for line in phone_file:
@@ -73,43 +84,208 @@ def preprocess_data(split, feat_dir, phone_path, concat_nframes, train_ratio=0.8
 
     usage_list = [line.strip('\n') for line in usage_list]
     print('[Dataset] - # phone classes: ' + str(class_num) + ', number of utterances for ' + split + ': ' + str(len(usage_list)))
-
-    max_len = 3000000
-    X = torch.empty(max_len, 39 * concat_nframes)
+    return mode, usage_list, label_dict
+
+def preprocess_data(split, feat_dir, phone_path, concat_nframes, train_ratio=0.8, train_val_seed=1337, num_workers=8, use_processes=False):
+    '''
+    num_workers: size of the pool the feature files are loaded and concatenated with (1 to do it serially).
+    use_processes: load the files in a process pool instead of a thread pool. The concatenation always runs
+    in threads, since it writes straight into X (torch releases the GIL while copying).
+    '''
+    mode, usage_list, label_dict = load_split(split, phone_path, train_ratio, train_val_seed)
+
+    # Pass 1: load the raw features (1 / concat_nframes of the output size) to get the exact number of frames.
+    feats = load_feats([os.path.join(feat_dir, mode, f'{fname}.pt') for fname in usage_list], num_workers, use_processes)
+    offsets = [0]
+    for feat in feats:
+        offsets.append(offsets[-1] + len(feat))
+    total_len = offsets[-1]
+
+    # Pass 2: allocate exactly total_len frames and fill them.
+    X = torch.empty(total_len, 39 * concat_nframes)
     if mode != 'test':
-      y = torch.empty(max_len, dtype=torch.long)
+      y = torch.empty(total_len, dtype=torch.long)
 
-    idx = 0
-    for i, fname in tqdm(enumerate(usage_list)):
-        feat = load_feat(os.path.join(feat_dir, mode, f'{fname}.pt'))
-        cur_len = len(feat)
-        feat = concat_feat(feat, concat_nframes)
+    def fill(i):
+        # Every utterance has its own precomputed rows, so the order matches usage_list whatever finishes first.
+        feat, feats[i] = feats[i], None # Release the raw features as soon as they are concatenated.
+        idx, cur_len = offsets[i], len(feat)
+        X[idx: idx + cur_len, :] = concat_feat(feat, concat_nframes)
         if mode != 'test':
-          label = torch.LongTensor(label_dict[fname])
+          y[idx: idx + cur_len] = torch.LongTensor(label_dict[usage_list[i]])
 
-        X[idx: idx + cur_len, :] = feat
-        if mode != 'test':
-          y[idx: idx + cur_len] = label
+    if num_workers <= 1:
+        for i in range(len(usage_list)):
+            fill(i)
+    else:
+        with ThreadPoolExecutor(num_workers) as pool:
+            list(pool.map(fill, range(len(usage_list))))
 
-        idx += cur_len
+    print(f'[INFO] {split} set')
+    print(X.shape)
+    print(f'[INFO] X: {X.element_size() * X.nelement() / 2**20:.1f} MB', end='')
+    if resource is not None:
+      print(f', peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB', end='') # ru_maxrss is in KB on Linux.
+    print()
+    if mode != 'test':
+      print(y.shape)
+      return X, y
+    else:
+      return X
 
-    X = X[:idx, :]
+def source_fingerprint(feat_dir, phone_path, mode):
+    '''Hash of the name, size and mtime of every file preprocess_data reads for mode.'''
+    digest = hashlib.sha1()
+    paths = [os.path.join(phone_path, f'{mode}_split.txt')]
     if mode != 'test':
-      y = y[:idx]
+        paths.append(os.path.join(phone_path, f'{mode}_labels.txt'))
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    for entry in sorted(os.scandir(os.path.join(feat_dir, mode)), key=lambda e: e.name):
+        stat = entry.stat()
+        digest.update(f'{entry.name}:{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    return digest.hexdigest()
+
+def cached_preprocess_data(split, feat_dir, phone_path, concat_nframes, train_ratio=0.8, train_val_seed=1337, num_workers=8,
+                           cache_dir='./cache', max_cache_bytes=50 * 2**30):
+    '''
+    preprocess_data with an on-disk cache keyed by the preprocessing parameters and the fingerprint of the source files.
+    X and y are returned as memory-mapped numpy arrays. The least recently used entries are evicted
+    once the cache is larger than max_cache_bytes.
+    '''
+    mode = 'train' if (split == 'train' or split == 'val') else 'test'
+    key = repr((split, concat_nframes, train_ratio, train_val_seed, source_fingerprint(feat_dir, phone_path, mode)))
+    entry = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+
+    if not os.path.isdir(entry):
+        data = preprocess_data(split, feat_dir, phone_path, concat_nframes, train_ratio, train_val_seed, num_workers)
+        data = data if mode != 'test' else (data,)
+        # Write into a temp dir and rename it, so an interrupted run never leaves a partial entry.
+        tmp_entry = f'{entry}.{os.getpid()}.tmp'
+        os.makedirs(tmp_entry, exist_ok=True)
+        for name, array in zip(('X', 'y'), data):
+            np.save(os.path.join(tmp_entry, f'{name}.npy'), array.numpy())
+        del data
+        try:
+            os.replace(tmp_entry, entry)
+        except OSError:
+            # Another run (or the other split) published the same entry first, use that one.
+            if not os.path.isdir(entry):
+                raise
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            print(f'[INFO] {split} set already cached by another run, using {entry}')
+        evict_cache(cache_dir, max_cache_bytes, keep=entry)
+    else:
+        print(f'[INFO] {split} set loaded from {entry}')
+    os.utime(entry) # mtime of the entry is its last use, for the LRU eviction
+
+    X = np.load(os.path.join(entry, 'X.npy'), mmap_mode='r')
+    if mode != 'test':
+      return X, np.load(os.path.join(entry, 'y.npy'), mmap_mode='r')
+    else:
+      return X
+
+def evict_cache(cache_dir, max_cache_bytes, keep=None, stale_tmp_seconds=6 * 3600):
+    '''
+    Removes the least recently used entries of cache_dir until it fits in max_cache_bytes.
+    Temp dirs untouched for stale_tmp_seconds are left over by crashed runs and removed as well.
+    '''
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and entry.name.endswith('.tmp'):
+            if time.time() - entry.stat().st_mtime > stale_tmp_seconds:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                print(f'[INFO] removed the stale {entry.path} from the preprocessing cache')
+        elif entry.is_dir():
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.stat().st_mtime, size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_cache_bytes:
+            break
+        if path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            print(f'[INFO] evicted {path} from the preprocessing cache')
+
+def preprocess_raw_data(split, feat_dir, phone_path, train_ratio=0.8, train_val_seed=1337, num_workers=8, use_processes=False):
+    '''
+    Like preprocess_data, but keeps the raw 39-dim frames of all utterances in one flat tensor
+    and the start of every utterance in offsets (plus the total length), for LibriWindowDataset.
+    '''
+    mode, usage_list, label_dict = load_split(split, phone_path, train_ratio, train_val_seed)
+
+    feats = load_feats([os.path.join(feat_dir, mode, f'{fname}.pt') for fname in usage_list], num_workers, use_processes)
+    offsets = torch.zeros(len(feats) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(torch.LongTensor([len(feat) for feat in feats]), dim=0)
+    X = torch.cat(feats, dim=0)
+    del feats
 
     print(f'[INFO] {split} set')
     print(X.shape)
     if mode != 'test':
+      y = torch.cat([torch.LongTensor(label_dict[fname]) for fname in usage_list])
       print(y.shape)
-      return X, y
+      return X, offsets, y
     else:
-      return X
+      return X, offsets
+
+def pack_feature_store(feat_dir, phone_path, store_dir, mode, num_workers=8, chunk_size=1000):
+    '''
+    Packs every utterance of {mode}_split.txt into one contiguous float32 features.bin (frames x 39),
+    their labels into one uint8 labels.bin (train only), and the utterance ids and frame offsets into index.npz.
+    '''
+    out_dir = os.path.join(store_dir, mode)
+    os.makedirs(out_dir, exist_ok=True)
+    _, usage_list, label_dict = load_split(mode, phone_path, train_ratio=1.0) # every utterance, train and val
+
+    offsets = [0]
+    with open(os.path.join(out_dir, 'features.bin'), 'wb') as feat_file, \
+         open(os.path.join(out_dir, 'labels.bin'), 'wb') as label_file:
+        # Stream the files in chunks, so packing never holds more than chunk_size utterances.
+        for start in range(0, len(usage_list), chunk_size):
+            fnames = usage_list[start: start + chunk_size]
+            feats = load_feats([os.path.join(feat_dir, mode, f'{fname}.pt') for fname in fnames], num_workers)
+            for fname, feat in zip(fnames, feats):
+                feat.numpy().astype(np.float32).tofile(feat_file)
+                if mode != 'test':
+                    np.asarray(label_dict[fname], dtype=np.uint8).tofile(label_file)
+                offsets.append(offsets[-1] + len(feat))
+
+    np.savez(os.path.join(out_dir, 'index.npz'), ids=np.array(usage_list), offsets=np.array(offsets, dtype=np.int64))
+    print(f'[INFO] packed {len(usage_list)} {mode} utterances, {offsets[-1]} frames into {out_dir}')
+
+def open_feature_store(store_dir, mode):
+    '''Memory-maps a store written by pack_feature_store, the pages are shared by every process opening it.'''
+    out_dir = os.path.join(store_dir, mode)
+    index = np.load(os.path.join(out_dir, 'index.npz'))
+    offsets = torch.from_numpy(index['offsets'])
+    X = np.memmap(os.path.join(out_dir, 'features.bin'), dtype=np.float32, mode='r', shape=(int(offsets[-1]), 39))
+    y = np.memmap(os.path.join(out_dir, 'labels.bin'), dtype=np.uint8, mode='r') if mode != 'test' else None
+    return {'ids': list(index['ids']), 'offsets': offsets, 'X': X, 'y': y}
+
+def store_split(store, split, phone_path, train_ratio=0.8, train_val_seed=1337):
+    '''
+    Selects the utterances of split from an opened store without copying any frame.
+    Returns (X, offsets, starts, y) for LibriWindowDataset: offsets are the cumulative lengths of the selected
+    utterances and starts where each of them begins in the store.
+    '''
+    _, usage_list, _ = load_split(split, phone_path, train_ratio, train_val_seed, with_labels=False)
+    position = {fname: i for i, fname in enumerate(store['ids'])}
+    utt = torch.LongTensor([position[fname] for fname in usage_list])
+
+    starts = store['offsets'][utt]
+    offsets = torch.zeros(len(utt) + 1, dtype=torch.long)
+    offsets[1:] = torch.cumsum(store['offsets'][utt + 1] - starts, dim=0)
+    return store['X'], offsets, starts, store['y']
 
 """## Define Dataset"""
 
 import torch
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
+from torch.utils.data import BatchSampler, RandomSampler, SequentialSampler
 
 
 class LibriDataset(Dataset):
@@ -129,11 +305,67 @@ class LibriDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+
+class LibriWindowDataset(Dataset):
+    '''
+    Frames of preprocess_raw_data (or of a feature store), concatenated with their neighbours only when they are fetched.
+    Indexing with a tensor / list of frame indices gathers the whole batch at once,
+    use it with window_loader so the DataLoader passes every batch of indices in one call.
+    X, y: tensors or (memory-mapped) numpy arrays of all frames.
+    offsets: cumulative lengths of the utterances of this dataset.
+    starts: where every utterance begins in X and y, defaults to offsets (the utterances are X itself).
+    '''
+    def __init__(self, X, offsets, concat_nframes, y=None, starts=None):
+        assert concat_nframes % 2 == 1 # n must be odd
+        self.data = X
+        self.offsets = offsets
+        self.starts = offsets[:-1] if starts is None else starts
+        self.concat_nframes = concat_nframes # Can be changed at any time, nothing is precomputed for it.
+        self.label = y
+
+    def _take(self, array, idx):
+        if isinstance(array, np.ndarray):
+            return torch.from_numpy(np.ascontiguousarray(array[idx.numpy()]))
+        return array[idx]
+
+    def __getitem__(self, idx):
+        idx = torch.as_tensor(idx, dtype=torch.long)
+        single = idx.dim() == 0
+        idx = idx.view(-1)
+
+        # Every frame is clamped to its own utterance, like shift repeats its first and last frame.
+        utt = torch.searchsorted(self.offsets, idx, right=True) - 1
+        center = self.starts[utt] + idx - self.offsets[utt]
+        start = self.starts[utt].unsqueeze(1)
+        end = start + (self.offsets[utt + 1] - self.offsets[utt]).unsqueeze(1) - 1
+        mid = self.concat_nframes // 2
+        pos = center.unsqueeze(1) + torch.arange(-mid, mid + 1)
+        pos = torch.minimum(torch.maximum(pos, start), end)
+
+        x = self._take(self.data, pos).view(len(idx), -1) # (B, concat_nframes * 39), same layout as concat_feat
+        if single:
+            x = x[0]
+        if self.label is not None:
+            label = self._take(self.label, center).long()
+            return x, label[0] if single else label
+        else:
+            return x
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+def window_loader(dataset, batch_size, shuffle):
+    '''DataLoader that hands whole batches of indices to LibriWindowDataset.__getitem__'''
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last=False), batch_size=None)
+
 """## Define Model"""
 
+import contextlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 class BasicBlock(nn.Module):
     def __init__(self, input_dim, output_dim):
@@ -222,9 +454,45 @@ class BasicBlock(nn.Module):
 #         #return outputs
 
 
+@contextlib.contextmanager
+def frozen_running_stats(module):
+    '''
+    BatchNorm layers of module normalize with the batch statistics but leave their running statistics alone.
+    The running statistics are still passed (and saved for backward) as in the first forward, which checkpoint
+    requires, momentum 0 keeps their values and num_batches_tracked is put back on exit.
+    '''
+    bns = [m for m in module.modules() if isinstance(m, nn.BatchNorm1d) and m.track_running_stats]
+    state = [(m.momentum, m.num_batches_tracked.clone()) for m in bns]
+    for m in bns:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, tracked) in zip(bns, state):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(tracked)
+
+def checkpoint_block(block, x):
+    '''
+    Runs block without keeping its activations, they are recomputed in the backward pass.
+    The RNG state is replayed so dropout draws the same masks, and the recomputation does not update
+    the BatchNorm running statistics a second time.
+    '''
+    recomputing = False
+    def run(x):
+        nonlocal recomputing
+        if recomputing:
+            with frozen_running_stats(block):
+                return block(x)
+        recomputing = True
+        return block(x)
+    return checkpoint(run, x, use_reentrant=False, preserve_rng_state=True)
+
 class Classifier(nn.Module):
-    def __init__(self, input_dim, output_dim=41, hidden_layers=5, hidden_dim=256):
+    '''checkpoint_blocks: recompute every BasicBlock in the backward pass while training, trading time for activation memory.'''
+    def __init__(self, input_dim, output_dim=41, hidden_layers=5, hidden_dim=256, checkpoint_blocks=False):
         super(Classifier, self).__init__()
+        self.checkpoint_blocks = checkpoint_blocks
 
         self.fc = nn.Sequential(
             BasicBlock(input_dim, hidden_dim),
@@ -234,51 +502,70 @@ class Classifier(nn.Module):
         )
 
     def forward(self, x):
+        if self.checkpoint_blocks and self.training and torch.is_grad_enabled():
+            for layer in self.fc:
+                x = checkpoint_block(layer, x) if isinstance(layer, BasicBlock) else layer(x)
+            return x
         x = self.fc(x)
         return x
 
-# FocalLoss
-import torch.nn.functional as F
-from torch.autograd import Variable
-
-class FocalLoss(nn.Module):
-    def __init__(self, gamma=2, alpha=None, size_average=True):
-        super(FocalLoss, self).__init__()
-        self.gamma = gamma
-        self.alpha = alpha
-        if isinstance(alpha,(float,int)): self.alpha = torch.Tensor([alpha,1-alpha])
-        if isinstance(alpha,list): self.alpha = torch.Tensor(alpha)
-        self.size_average = size_average
-
-    def forward(self, input, target):
-        if input.dim()>2:
-            input = input.view(input.size(0),input.size(1),-1)  # N,C,H,W => N,C,H*W
-            input = input.transpose(1,2)    # N,C,H*W => N,H*W,C
-            input = input.contiguous().view(-1,input.size(2))   # N,H*W,C => N*H*W,C
-        target = target.view(-1,1)
-
-        logpt = F.log_softmax(input)
-        logpt = logpt.gather(1,target)
-        logpt = logpt.view(-1)
-        pt = Variable(logpt.data.exp())
-
-        if self.alpha is not None:
-            if self.alpha.type()!=input.data.type():
-                self.alpha = self.alpha.type_as(input.data)
-            at = self.alpha.gather(0,target.data.view(-1))
-            logpt = logpt * Variable(at)
-
-        loss = -1 * (1-pt)**self.gamma * logpt
-        if self.size_average: return loss.mean()
-        else: return loss.sum()
+import gc
+import numpy as np
 
+def predict(model, loader, n_frames, device, log_post=None):
+    '''
+    Predicted class of every frame, written into a preallocated int16 array of n_frames in loader order.
+    If log_post (n_frames, 41) is given, the log-posteriors are written into it as well.
+    '''
+    pred = np.empty(n_frames, dtype=np.int16)
+    idx = 0
+    model.eval()
+    with torch.no_grad():
+        for i, batch in enumerate(tqdm(loader)):
+            features = batch
+            features = features.to(device)
+
+            outputs = model(features)
+
+            _, test_pred = torch.max(outputs, 1) # get the index of the class with the highest probability
+            pred[idx: idx + len(outputs)] = test_pred.cpu().numpy()
+            if log_post is not None:
+                log_post[idx: idx + len(outputs)] = F.log_softmax(outputs, dim=1).cpu()
+            idx += len(outputs)
+    return pred
+
+def save_prediction(pred, path, chunk_size=1000000, npy_path=None):
+    '''Writes the Id,Class csv with one write per chunk_size frames, and optionally pred itself as a .npy.'''
+    with open(path, 'w') as f:
+        f.write('Id,Class\n')
+        for start in range(0, len(pred), chunk_size):
+            chunk = pred[start: start + chunk_size]
+            f.write(pd.DataFrame({'Id': np.arange(start, start + len(chunk)), 'Class': chunk}).to_csv(header=False, index=False))
+    if npy_path is not None:
+        np.save(npy_path, pred)
 
+#fix seed
+def same_seeds(seed):
+    torch.manual_seed(seed)
+    if torch.cuda.is_available():
+        torch.cuda.manual_seed(seed)
+        torch.cuda.manual_seed_all(seed)  
+    np.random.seed(seed)  
+    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = True
 
 """## Hyper-parameters"""
 
 # data prarameters
 concat_nframes = 21              # the number of frames to concat with, n must be odd (total 2k+1 = n frames)
 train_ratio = 0.8               # the ratio of data used for training, the rest will be used for validation
+lazy_window = True              # keep only the raw frames and concatenate the windows per batch (LibriWindowDataset)
+num_workers = 8                 # the number of threads loading the feature files
+preprocess_cache = './cache'    # cache of the preprocessed splits (lazy_window = False), None to always preprocess
+cache_max_gb = 50               # disk budget of the preprocessing cache
+prediction_npy = None           # e.g. './prediction.npy', also save the predictions as a binary array
+viterbi_smoothing = False       # smooth the test predictions with a phone HMM (needs lazy_window for the utterance offsets)
+feature_store = None            # e.g. './libriphone/store', pack the features once and memory-map them (needs lazy_window)
 
 # training parameters
 seed = 91322                       # random seed
@@ -286,166 +573,208 @@ batch_size = 256                # batch size
 num_epoch = 200                  # the number of training epoch
 learning_rate = 1e-4          # learning rate
 model_path = './model.ckpt'     # the path where the checkpoint will be saved
+test_model_path = None          # e.g. './model_int8.pt' or './model_low_rank.pt' from compress.py, test with that TorchScript model
 
 # model parameters
 input_dim = 39 * concat_nframes # the input dim of the model, you should not change the value
 hidden_layers = 2               # the number of hidden layers
 hidden_dim = 1700               # the hidden dim
-
-"""## Prepare dataset and model"""
-
-import gc
-
-# preprocess data
-train_X, train_y = preprocess_data(split='train', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, train_ratio=train_ratio)
-val_X, val_y = preprocess_data(split='val', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, train_ratio=train_ratio)
-
-# get dataset
-train_set = LibriDataset(train_X, train_y)
-val_set = LibriDataset(val_X, val_y)
-
-# remove raw feature to save memory
-del train_X, train_y, val_X, val_y
-gc.collect()
-
-# get dataloader
-train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
-val_loader = DataLoader(val_set, batch_size=batch_size, shuffle=False)
-
-device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
-print(f'DEVICE: {device}')
-
-import numpy as np
-
-#fix seed
-def same_seeds(seed):
-    torch.manual_seed(seed)
-    if torch.cuda.is_available():
-        torch.cuda.manual_seed(seed)
-        torch.cuda.manual_seed_all(seed)  
-    np.random.seed(seed)  
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
-
-# fix random seed
-same_seeds(seed)
-
-# create model, define a loss function, and optimizer
-model = Classifier(input_dim=input_dim, hidden_layers=hidden_layers, hidden_dim=hidden_dim,).to(device)
-# model = LSTM(input_size=input_dim, num_layers=hidden_layers, hidden_size=hidden_dim,).to(device)
-#criterion = FocalLoss()
-criterion = nn.CrossEntropyLoss()
-#optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=0.05)
-
-"""## Training"""
-
-best_acc = 0.0
-for epoch in range(num_epoch):
-    train_acc = 0.0
-    train_loss = 0.0
-    val_acc = 0.0
-    val_loss = 0.0
-    
-    if epoch == 0:
-        optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-4)
-    elif epoch == 50:
-        optimizer = torch.optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9)
-
-
-    # training
-    model.train() # set the model to training mode
-    for i, batch in enumerate(tqdm(train_loader)):
-        features, labels = batch
-        features = features.to(device)
-        labels = labels.to(device)
-        
-        optimizer.zero_grad() 
-        outputs = model(features) 
-        
-        loss = criterion(outputs, labels)
-        loss.backward() 
-        optimizer.step() 
-        
-        _, train_pred = torch.max(outputs, 1) # get the index of the class with the highest probability
-        train_acc += (train_pred.detach() == labels.detach()).sum().item()
-        train_loss += loss.item()
-    
-    # validation
-    if len(val_set) > 0:
-        model.eval() # set the model to evaluation mode
-        with torch.no_grad():
-            for i, batch in enumerate(tqdm(val_loader)):
-                features, labels = batch
-                features = features.to(device)
-                labels = labels.to(device)
-                outputs = model(features)
-                
-                loss = criterion(outputs, labels) 
-                
-                _, val_pred = torch.max(outputs, 1) 
-                val_acc += (val_pred.cpu() == labels.cpu()).sum().item() # get the index of the class with the highest probability
-                val_loss += loss.item()
-
-            print('[{:03d}/{:03d}] Train Acc: {:3.6f} Loss: {:3.6f} | Val Acc: {:3.6f} loss: {:3.6f}'.format(
-                epoch + 1, num_epoch, train_acc/len(train_set), train_loss/len(train_loader), val_acc/len(val_set), val_loss/len(val_loader)
+checkpoint_blocks = False       # recompute the BasicBlocks in the backward pass, for larger batches or deeper stacks in limited memory
+
+if __name__ == '__main__':
+    """## Prepare dataset and model"""
+
+    if feature_store is not None and not lazy_window:
+        raise ValueError('feature_store needs lazy_window = True')
+    if viterbi_smoothing and not lazy_window:
+        raise ValueError('viterbi_smoothing needs lazy_window = True for the utterance offsets')
+
+    if lazy_window and feature_store is not None:
+        for mode in ('train', 'test'):
+            if not os.path.exists(os.path.join(feature_store, mode, 'index.npz')):
+                pack_feature_store('./libriphone/feat', './libriphone', feature_store, mode, num_workers=num_workers)
+        store = open_feature_store(feature_store, 'train')
+
+        # select the utterances of each split, the frames stay in the memory-mapped store
+        train_X, train_offsets, train_starts, train_y = store_split(store, 'train', './libriphone', train_ratio=train_ratio)
+        val_X, val_offsets, val_starts, val_y = store_split(store, 'val', './libriphone', train_ratio=train_ratio)
+
+        # get dataset
+        train_set = LibriWindowDataset(train_X, train_offsets, concat_nframes, train_y, starts=train_starts)
+        val_set = LibriWindowDataset(val_X, val_offsets, concat_nframes, val_y, starts=val_starts)
+
+        # get dataloader
+        train_loader = window_loader(train_set, batch_size, shuffle=True)
+        val_loader = window_loader(val_set, batch_size, shuffle=False)
+    elif lazy_window:
+        # preprocess data
+        train_X, train_offsets, train_y = preprocess_raw_data(split='train', feat_dir='./libriphone/feat', phone_path='./libriphone', train_ratio=train_ratio, num_workers=num_workers)
+        val_X, val_offsets, val_y = preprocess_raw_data(split='val', feat_dir='./libriphone/feat', phone_path='./libriphone', train_ratio=train_ratio, num_workers=num_workers)
+
+        # get dataset
+        train_set = LibriWindowDataset(train_X, train_offsets, concat_nframes, train_y)
+        val_set = LibriWindowDataset(val_X, val_offsets, concat_nframes, val_y)
+
+        # get dataloader
+        train_loader = window_loader(train_set, batch_size, shuffle=True)
+        val_loader = window_loader(val_set, batch_size, shuffle=False)
+    else:
+        # preprocess data
+        if preprocess_cache is not None:
+            train_X, train_y = cached_preprocess_data(split='train', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, train_ratio=train_ratio, num_workers=num_workers,
+                                                      cache_dir=preprocess_cache, max_cache_bytes=cache_max_gb * 2**30)
+            val_X, val_y = cached_preprocess_data(split='val', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, train_ratio=train_ratio, num_workers=num_workers,
+                                                  cache_dir=preprocess_cache, max_cache_bytes=cache_max_gb * 2**30)
+        else:
+            train_X, train_y = preprocess_data(split='train', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, train_ratio=train_ratio, num_workers=num_workers)
+            val_X, val_y = preprocess_data(split='val', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, train_ratio=train_ratio, num_workers=num_workers)
+
+        # get dataset
+        train_set = LibriDataset(train_X, train_y)
+        val_set = LibriDataset(val_X, val_y)
+
+        # get dataloader
+        train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True)
+        val_loader = DataLoader(val_set, batch_size=batch_size, shuffle=False)
+
+    # remove raw feature to save memory
+    del train_X, train_y, val_X, val_y
+    gc.collect()
+
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    print(f'DEVICE: {device}')
+
+    # fix random seed
+    same_seeds(seed)
+
+    # create model, define a loss function, and optimizer
+    model = Classifier(input_dim=input_dim, hidden_layers=hidden_layers, hidden_dim=hidden_dim, checkpoint_blocks=checkpoint_blocks).to(device)
+    # model = LSTM(input_size=input_dim, num_layers=hidden_layers, hidden_size=hidden_dim,).to(device)
+    #criterion = FocalLoss()
+    criterion = nn.CrossEntropyLoss()
+    #optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=0.05)
+
+    """## Training"""
+
+    best_acc = 0.0
+    for epoch in range(num_epoch):
+        # the sums stay on the device and are read back once per epoch, so the loop never waits for a .item()
+        metrics = MetricAccumulator(device)
+
+        if epoch == 0:
+            optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-4)
+        elif epoch == 50:
+            optimizer = torch.optim.SGD(model.parameters(), lr=learning_rate, momentum=0.9)
+
+
+        # training
+        model.train() # set the model to training mode
+        for i, batch in enumerate(tqdm(train_loader)):
+            features, labels = batch
+            features = features.to(device)
+            labels = labels.to(device)
+
+            optimizer.zero_grad() 
+            outputs = model(features) 
+
+            loss = criterion(outputs, labels)
+            loss.backward() 
+            optimizer.step() 
+
+            _, train_pred = torch.max(outputs, 1) # get the index of the class with the highest probability
+            metrics.update(train_acc=(train_pred.detach() == labels.detach()).sum(), train_loss=loss)
+
+        # validation
+        if len(val_set) > 0:
+            model.eval() # set the model to evaluation mode
+            with torch.no_grad():
+                for i, batch in enumerate(tqdm(val_loader)):
+                    features, labels = batch
+                    features = features.to(device)
+                    labels = labels.to(device)
+                    outputs = model(features)
+
+                    loss = criterion(outputs, labels) 
+
+                    _, val_pred = torch.max(outputs, 1) 
+                    metrics.update(val_acc=(val_pred == labels).sum(), val_loss=loss) # get the index of the class with the highest probability
+
+                totals = metrics.compute()
+                train_acc, train_loss, val_acc, val_loss = totals['train_acc'], totals['train_loss'], totals['val_acc'], totals['val_loss']
+                print('[{:03d}/{:03d}] Train Acc: {:3.6f} Loss: {:3.6f} | Val Acc: {:3.6f} loss: {:3.6f}'.format(
+                    epoch + 1, num_epoch, train_acc/len(train_set), train_loss/len(train_loader), val_acc/len(val_set), val_loss/len(val_loader)
+                ))
+
+                # if the model improves, save a checkpoint at this epoch
+                if val_acc > best_acc:
+                    best_acc = val_acc
+                    torch.save(model.state_dict(), model_path)
+                    print('saving model with acc {:.3f}'.format(best_acc/len(val_set)))
+        else:
+            totals = metrics.compute()
+            train_acc, train_loss = totals['train_acc'], totals['train_loss']
+            print('[{:03d}/{:03d}] Train Acc: {:3.6f} Loss: {:3.6f}'.format(
+                epoch + 1, num_epoch, train_acc/len(train_set), train_loss/len(train_loader)
             ))
 
-            # if the model improves, save a checkpoint at this epoch
-            if val_acc > best_acc:
-                best_acc = val_acc
-                torch.save(model.state_dict(), model_path)
-                print('saving model with acc {:.3f}'.format(best_acc/len(val_set)))
+    # if not validating, save the last epoch
+    if len(val_set) == 0:
+        torch.save(model.state_dict(), model_path)
+        print('saving model at last epoch')
+
+    del train_loader, val_loader
+    gc.collect()
+
+    """## Testing
+    Create a testing dataset, and load model from the saved checkpoint.
+    """
+
+    # load data
+    if lazy_window and feature_store is not None:
+        test_X, test_offsets, test_starts, _ = store_split(open_feature_store(feature_store, 'test'), 'test', './libriphone')
+        test_set = LibriWindowDataset(test_X, test_offsets, concat_nframes, None, starts=test_starts)
+        test_loader = window_loader(test_set, batch_size, shuffle=False)
+    elif lazy_window:
+        test_X, test_offsets = preprocess_raw_data(split='test', feat_dir='./libriphone/feat', phone_path='./libriphone', num_workers=num_workers)
+        test_set = LibriWindowDataset(test_X, test_offsets, concat_nframes, None)
+        test_loader = window_loader(test_set, batch_size, shuffle=False)
     else:
-        print('[{:03d}/{:03d}] Train Acc: {:3.6f} Loss: {:3.6f}'.format(
-            epoch + 1, num_epoch, train_acc/len(train_set), train_loss/len(train_loader)
-        ))
-
-# if not validating, save the last epoch
-if len(val_set) == 0:
-    torch.save(model.state_dict(), model_path)
-    print('saving model at last epoch')
-
-del train_loader, val_loader
-gc.collect()
-
-"""## Testing
-Create a testing dataset, and load model from the saved checkpoint.
-"""
-
-# load data
-test_X = preprocess_data(split='test', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes)
-test_set = LibriDataset(test_X, None)
-test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=False)
-
-# load model
-# model = Classifier(input_dim=input_dim, hidden_layers=hidden_layers, hidden_dim=hidden_dim).to(device)
-model = LSTM(input_size=input_dim, num_layers=hidden_layers, hidden_size=hidden_dim,).to(device)
-
-model.load_state_dict(torch.load(model_path))
-
-"""Make prediction."""
+        if preprocess_cache is not None:
+            test_X = cached_preprocess_data(split='test', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, num_workers=num_workers,
+                                            cache_dir=preprocess_cache, max_cache_bytes=cache_max_gb * 2**30)
+        else:
+            test_X = preprocess_data(split='test', feat_dir='./libriphone/feat', phone_path='./libriphone', concat_nframes=concat_nframes, num_workers=num_workers)
+        test_set = LibriDataset(test_X, None)
+        test_loader = DataLoader(test_set, batch_size=batch_size, shuffle=False)
+
+    # load model
+    test_device = device
+    if test_model_path is not None:
+        model = torch.jit.load(test_model_path, map_location='cpu')
+        # The int8 model of compress.py only has CPU (fbgemm / qnnpack) kernels, so it is tested on the CPU.
+        if 'quantized::' in str(model.inlined_graph):
+            test_device = 'cpu'
+        else:
+            model = model.to(device)
+    else:
+        model = Classifier(input_dim=input_dim, hidden_layers=hidden_layers, hidden_dim=hidden_dim).to(device)
+        # model = LSTM(input_size=input_dim, num_layers=hidden_layers, hidden_size=hidden_dim,).to(device)
 
-test_acc = 0.0
-test_lengths = 0
-pred = np.array([], dtype=np.int32)
+        model.load_state_dict(torch.load(model_path))
 
-model.eval()
-with torch.no_grad():
-    for i, batch in enumerate(tqdm(test_loader)):
-        features = batch
-        features = features.to(device)
+    """Make prediction."""
 
-        outputs = model(features)
+    log_post = torch.empty(len(test_set), 41) if viterbi_smoothing else None
+    pred = predict(model, test_loader, len(test_set), test_device, log_post)
 
-        _, test_pred = torch.max(outputs, 1) # get the index of the class with the highest probability
-        pred = np.concatenate((pred, test_pred.cpu().numpy()), axis=0)
+    if viterbi_smoothing:
+        from viterbi import estimate_transitions, viterbi_decode
+        log_A, log_pi, log_prior = estimate_transitions('./libriphone')
+        pred = viterbi_decode(log_post, test_offsets, log_A, log_pi, log_prior).astype(np.int16)
 
-"""Write prediction to a CSV file.
+    """Write prediction to a CSV file.
 
-After finish running this block, download the file `prediction.csv` from the files section on the left-hand side and submit it to Kaggle.
-"""
+    After finish running this block, download the file `prediction.csv` from the files section on the left-hand side and submit it to Kaggle.
+    """
 
-with open('prediction.csv', 'w') as f:
-    f.write('Id,Class\n')
-    for i, y in enumerate(pred):
-        f.write('{},{}\n'.format(i, y))
\ No newline at end of file
+    save_prediction(pred, 'prediction.csv', npy_path=prediction_npy)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""HW2 utterance-level sequence model.
+
+Instead of copying every frame into concat_nframes overlapping windows, whole utterances are fed to a
+conv + BiLSTM classifier that predicts all of their frames in one pass. Utterances of similar length are
+bucketed into the same batch, so padding stays small, and the LSTM skips it with pack_padded_sequence.
+"""
+
+import gc
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
+from torch.utils.data import Dataset, DataLoader, Sampler
+from tqdm import tqdm
+
+from hw2 import preprocess_raw_data, same_seeds, save_prediction
+from common import MetricAccumulator # importing hw2 put the repository root on sys.path
+
+"""## Define Dataset"""
+
+class LibriUtteranceDataset(Dataset):
+    '''
+    One item per utterance: (index, frames (T, 39), labels (T)) of preprocess_raw_data outputs.
+    offsets: cumulative lengths of the utterances of X.
+    '''
+    def __init__(self, X, offsets, y=None):
+        self.data = X
+        self.offsets = offsets
+        self.label = y
+        self.lengths = (offsets[1:] - offsets[:-1]).tolist()
+
+    def __getitem__(self, idx):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        if self.label is not None:
+            return idx, self.data[start: end], self.label[start: end]
+        else:
+            return idx, self.data[start: end], None
+
+    def __len__(self):
+        return len(self.lengths)
+
+class BucketBatchSampler(Sampler):
+    '''
+    Batches of utterances of similar length, with at most max_frames frames per batch including padding.
+    Utterances are shuffled, cut into buckets of bucket_size, sorted by length inside each bucket and
+    batched greedily, then the order of the batches is shuffled.
+    '''
+    def __init__(self, lengths, max_frames, shuffle=True, bucket_size=1000):
+        self.lengths = lengths
+        self.max_frames = max_frames
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.batches = self._make_batches()
+
+    def _make_batches(self):
+        n = len(self.lengths)
+        order = torch.randperm(n).tolist() if self.shuffle else list(range(n))
+        batches = []
+        for start in range(0, n, self.bucket_size):
+            batch, longest = [], 0
+            for i in sorted(order[start: start + self.bucket_size], key=lambda i: self.lengths[i]):
+                if batch and max(longest, self.lengths[i]) * (len(batch) + 1) > self.max_frames:
+                    batches.append(batch)
+                    batch, longest = [], 0
+                batch.append(i)
+                longest = max(longest, self.lengths[i])
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        return batches
+
+    def __iter__(self):
+        yield from self.batches
+        if self.shuffle:
+            self.batches = self._make_batches() # the next epoch gets a new shuffle
+
+    def __len__(self):
+        return len(self.batches)
+
+def collate_utterances(batch):
+    '''Pads a list of utterances to (B, T, 39) frames and (B, T) labels, padded labels are -100 (ignored by the loss).'''
+    idx, feats, labels = zip(*batch)
+    lengths = torch.LongTensor([len(feat) for feat in feats])
+    feats = pad_sequence(feats, batch_first=True)
+    if labels[0] is not None:
+        labels = pad_sequence(labels, batch_first=True, padding_value=-100)
+    else:
+        labels = None
+    return torch.LongTensor(idx), feats, lengths, labels
+
+"""## Define Model"""
+
+class SeqClassifier(nn.Module):
+    '''
+    Conv1d front end over neighbouring frames, then a BiLSTM over the whole utterance and a frame-wise classifier.
+    x: (B, T, input_dim), lengths: (B) -> (B, T, output_dim)
+    '''
+    def __init__(self, input_dim=39, output_dim=41, conv_dim=256, kernel_size=5, hidden_dim=512, num_layers=3, dropout=0.3):
+        super(SeqClassifier, self).__init__()
+        self.conv = nn.Conv1d(input_dim, conv_dim, kernel_size, padding=kernel_size // 2)
+        # LayerNorm normalizes every frame on its own, so the padding does not leak into the statistics like BatchNorm.
+        self.norm = nn.Sequential(
+            nn.LayerNorm(conv_dim),
+            nn.SiLU(),
+        )
+        self.lstm = nn.LSTM(conv_dim, hidden_dim, num_layers, batch_first=True, bidirectional=True, dropout=dropout)
+        self.fc = nn.Sequential(
+            nn.Linear(2 * hidden_dim, 1024),
+            nn.SiLU(),
+            nn.Dropout(dropout),
+            nn.Linear(1024, output_dim),
+        )
+
+    def forward(self, x, lengths):
+        x = self.conv(x.transpose(1, 2)).transpose(1, 2) # (B, T, conv_dim)
+        x = self.norm(x)
+        packed = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        out, _ = self.lstm(packed)
+        out, _ = pad_packed_sequence(out, batch_first=True, total_length=x.size(1))
+        return self.fc(out)
+
+"""## Hyper-parameters"""
+
+# data prarameters
+train_ratio = 0.8               # the ratio of data used for training, the rest will be used for validation
+num_workers = 8                 # the number of threads loading the feature files
+
+# training parameters
+seed = 91322                    # random seed
+max_frames = 40000              # the number of frames (including padding) of a batch
+num_epoch = 60                  # the number of training epoch
+learning_rate = 1e-3            # learning rate
+model_path = './seq_model.ckpt' # the path where the checkpoint will be saved
+
+# model parameters
+hidden_dim = 512                # the hidden dim of the LSTM
+hidden_layers = 3               # the number of LSTM layers
+
+def predict(model, loader, offsets, device):
+    '''Returns the predicted class of every frame, in the order of the frames of the dataset.'''
+    pred = np.empty(int(offsets[-1]), dtype=np.int32)
+    model.eval()
+    with torch.no_grad():
+        for idx, features, lengths, _ in tqdm(loader):
+            outputs = model(features.to(device), lengths)
+            test_pred = outputs.argmax(dim=-1).cpu().numpy()
+            # Batches are bucketed, so every utterance is written back at its own offset.
+            for b, i in enumerate(idx.tolist()):
+                pred[int(offsets[i]): int(offsets[i + 1])] = test_pred[b, :int(lengths[b])]
+    return pred
+
+if __name__ == '__main__':
+    """## Prepare dataset and model"""
+
+    same_seeds(seed)
+
+    train_X, train_offsets, train_y = preprocess_raw_data(split='train', feat_dir='./libriphone/feat', phone_path='./libriphone', train_ratio=train_ratio, num_workers=num_workers)
+    val_X, val_offsets, val_y = preprocess_raw_data(split='val', feat_dir='./libriphone/feat', phone_path='./libriphone', train_ratio=train_ratio, num_workers=num_workers)
+
+    train_set = LibriUtteranceDataset(train_X, train_offsets, train_y)
+    val_set = LibriUtteranceDataset(val_X, val_offsets, val_y)
+    n_train_frames, n_val_frames = int(train_offsets[-1]), int(val_offsets[-1])
+
+    train_loader = DataLoader(train_set, batch_sampler=BucketBatchSampler(train_set.lengths, max_frames, shuffle=True), collate_fn=collate_utterances)
+    val_loader = DataLoader(val_set, batch_sampler=BucketBatchSampler(val_set.lengths, max_frames, shuffle=False), collate_fn=collate_utterances)
+
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+    print(f'DEVICE: {device}')
+
+    model = SeqClassifier(hidden_dim=hidden_dim, num_layers=hidden_layers).to(device)
+    criterion = nn.CrossEntropyLoss(ignore_index=-100)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=1e-4)
+
+    """## Training"""
+
+    best_acc = 0.0
+    for epoch in range(num_epoch):
+        metrics = MetricAccumulator(device) # read back once per epoch
+        n_train_batches, n_val_batches = len(train_loader), len(val_loader) # the sampler reshuffles after every epoch
+
+        # training
+        model.train() # set the model to training mode
+        for i, batch in enumerate(tqdm(train_loader)):
+            _, features, lengths, labels = batch
+            features = features.to(device)
+            labels = labels.to(device)
+
+            optimizer.zero_grad()
+            outputs = model(features, lengths)
+
+            loss = criterion(outputs.view(-1, outputs.size(-1)), labels.view(-1))
+            loss.backward()
+            nn.utils.clip_grad_norm_(model.parameters(), max_norm=5)
+            optimizer.step()
+
+            train_pred = outputs.argmax(dim=-1) # get the index of the class with the highest probability
+            metrics.update(train_acc=(train_pred.detach() == labels).sum(), train_loss=loss) # padded labels are -100 and never match
+
+        # validation
+        model.eval() # set the model to evaluation mode
+        with torch.no_grad():
+            for i, batch in enumerate(tqdm(val_loader)):
+                _, features, lengths, labels = batch
+                features = features.to(device)
+                labels = labels.to(device)
+                outputs = model(features, lengths)
+
+                loss = criterion(outputs.view(-1, outputs.size(-1)), labels.view(-1))
+
+                val_pred = outputs.argmax(dim=-1)
+                metrics.update(val_acc=(val_pred == labels).sum(), val_loss=loss)
+
+        totals = metrics.compute()
+        train_acc, train_loss, val_acc, val_loss = totals['train_acc'], totals['train_loss'], totals['val_acc'], totals['val_loss']
+        print('[{:03d}/{:03d}] Train Acc: {:3.6f} Loss: {:3.6f} | Val Acc: {:3.6f} loss: {:3.6f}'.format(
+            epoch + 1, num_epoch, train_acc/n_train_frames, train_loss/n_train_batches, val_acc/n_val_frames, val_loss/n_val_batches
+        ))
+
+        # if the model improves, save a checkpoint at this epoch
+        if val_acc > best_acc:
+            best_acc = val_acc
+            torch.save(model.state_dict(), model_path)
+            print('saving model with acc {:.3f}'.format(best_acc/n_val_frames))
+
+    del train_loader, val_loader, train_set, val_set, train_X, train_y, val_X, val_y
+    gc.collect()
+
+    """## Testing"""
+
+    test_X, test_offsets = preprocess_raw_data(split='test', feat_dir='./libriphone/feat', phone_path='./libriphone', num_workers=num_workers)
+    test_set = LibriUtteranceDataset(test_X, test_offsets, None)
+    test_loader = DataLoader(test_set, batch_sampler=BucketBatchSampler(test_set.lengths, max_frames, shuffle=False), collate_fn=collate_utterances)
+
+    model.load_state_dict(torch.load(model_path))
+    pred = predict(model, test_loader, test_offsets, device)
+
+    save_prediction(pred, 'prediction.csv')
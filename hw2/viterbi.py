@@ -0,0 +1,85 @@
+# Viterbi smoothing of HW2 frame predictions.
+# The per-frame log-posteriors of the classifier are decoded with an HMM whose phone transition matrix is
+# estimated from train_labels.txt, so the predicted phone sequence of an utterance follows likely transitions.
+
+import os
+
+import numpy as np
+import torch
+
+
+def estimate_transitions(phone_path, class_num=41, smoothing=1.0):
+    '''
+    Returns the log transition matrix (class_num x class_num), the log initial distribution
+    and the log class prior, counted from train_labels.txt with add-smoothing.
+    '''
+    counts = np.full((class_num, class_num), smoothing)
+    init = np.full(class_num, smoothing)
+    prior = np.full(class_num, smoothing)
+    with open(os.path.join(phone_path, 'train_labels.txt')) as f:
+        for line in f:
+            labels = np.array(line.split()[1:], dtype=np.int64)
+            if len(labels) == 0:
+                continue
+            np.add.at(counts, (labels[:-1], labels[1:]), 1)
+            init[labels[0]] += 1
+            prior += np.bincount(labels, minlength=class_num)
+
+    log_A = np.log(counts / counts.sum(axis=1, keepdims=True))
+    log_pi = np.log(init / init.sum())
+    log_prior = np.log(prior / prior.sum())
+    return torch.from_numpy(log_A).float(), torch.from_numpy(log_pi).float(), torch.from_numpy(log_prior).float()
+
+
+def viterbi_batch(emit, lengths, log_A, log_pi):
+    '''
+    Most likely state path of every utterance of a padded batch.
+    emit: (B, T, C) log emission scores, lengths: (B) -> (B, T) states (padded steps repeat the last state).
+    Only the time axis is a Python loop, every step is vectorized over the batch and the states.
+    '''
+    B, T, C = emit.shape
+    backptr = torch.empty(B, T, C, dtype=torch.uint8) # C = 41 states fit in uint8
+    ident = torch.arange(C).expand(B, C)
+
+    delta = log_pi + emit[:, 0]
+    for t in range(1, T):
+        best, arg = (delta.unsqueeze(2) + log_A).max(dim=1) # (B, C_prev, C_next) -> (B, C_next)
+        valid = (t < lengths).unsqueeze(1)
+        # Past the end of an utterance its scores are frozen and the back pointers point to the same state.
+        delta = torch.where(valid, best + emit[:, t], delta)
+        backptr[:, t] = torch.where(valid, arg, ident)
+
+    path = torch.empty(B, T, dtype=torch.long)
+    path[:, T - 1] = delta.argmax(dim=1)
+    for t in range(T - 1, 0, -1):
+        path[:, t - 1] = backptr[:, t].long().gather(1, path[:, t: t + 1]).squeeze(1)
+    return path
+
+
+def viterbi_decode(log_post, offsets, log_A, log_pi, log_prior=None, prior_scale=1.0, transition_weight=1.0, batch_size=256):
+    '''
+    Decodes every utterance of the flat (N, C) log-posteriors, utterance i being frames offsets[i]:offsets[i+1].
+    Posteriors are turned into scaled likelihoods by subtracting prior_scale * log_prior.
+    Utterances are sorted by length and decoded in padded batches. Returns (N) int predictions.
+    '''
+    log_post = torch.as_tensor(log_post, dtype=torch.float32)
+    offsets = torch.as_tensor(offsets, dtype=torch.long)
+    if log_prior is not None:
+        log_post = log_post - prior_scale * log_prior
+    log_A = log_A * transition_weight
+
+    lengths = offsets[1:] - offsets[:-1]
+    order = torch.argsort(lengths)
+    pred = torch.empty(len(log_post), dtype=torch.long)
+    for start in range(0, len(order), batch_size):
+        utt = order[start: start + batch_size]
+        utt_lengths = lengths[utt]
+        T = int(utt_lengths.max())
+        # One gather builds the padded batch, positions past the end are clamped to the last frame.
+        steps = torch.arange(T).unsqueeze(0)
+        pos = offsets[utt].unsqueeze(1) + torch.minimum(steps, utt_lengths.unsqueeze(1) - 1)
+        path = viterbi_batch(log_post[pos], utt_lengths, log_A, log_pi)
+
+        mask = steps < utt_lengths.unsqueeze(1)
+        pred[pos[mask]] = path[mask]
+    return pred.numpy()
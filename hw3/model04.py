@@ -40,6 +40,10 @@ from sklearn.model_selection import KFold
 from tqdm.auto import tqdm
 import random
 
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')) # the repository root, for the shared common package
+from common import MetricAccumulator, FocalLoss
+
 myseed = 6666  # set a random seed for reproducibility
 torch.backends.cudnn.deterministic = True
 torch.backends.cudnn.benchmark = False
@@ -159,40 +163,6 @@ class Classifier(nn.Module):
         out = self.cnn(x)
         out = out.view(out.size()[0], -1)
         return self.fc(out)
-# FocalLoss
-import torch.nn.functional as F
-from torch.autograd import Variable
-
-class FocalLoss(nn.Module):
-    def __init__(self, gamma=2, alpha=None, size_average=True):
-        super(FocalLoss, self).__init__()
-        self.gamma = gamma
-        self.alpha = alpha
-        if isinstance(alpha,(float,int)): self.alpha = torch.Tensor([alpha,1-alpha])
-        if isinstance(alpha,list): self.alpha = torch.Tensor(alpha)
-        self.size_average = size_average
-
-    def forward(self, input, target):
-        if input.dim()>2:
-            input = input.view(input.size(0),input.size(1),-1)  # N,C,H,W => N,C,H*W
-            input = input.transpose(1,2)    # N,C,H*W => N,H*W,C
-            input = input.contiguous().view(-1,input.size(2))   # N,H*W,C => N*H*W,C
-        target = target.view(-1,1)
-
-        logpt = F.log_softmax(input)
-        logpt = logpt.gather(1,target)
-        logpt = logpt.view(-1)
-        pt = Variable(logpt.data.exp())
-
-        if self.alpha is not None:
-            if self.alpha.type()!=input.data.type():
-                self.alpha = self.alpha.type_as(input.data)
-            at = self.alpha.gather(0,target.data.view(-1))
-            logpt = logpt * Variable(at)
-
-        loss = -1 * (1-pt)**self.gamma * logpt
-        if self.size_average: return loss.mean()
-        else: return loss.sum()
 
 
 batch_size = 32
@@ -234,8 +204,7 @@ for epoch in range(n_epochs):
     model.train()
 
     # These are used to record information in training.
-    train_loss = []
-    train_accs = []
+    metrics = MetricAccumulator(device) # read back once per epoch, not after every batch
 
     if epoch == 0:
             optimizer = torch.optim.AdamW(model.parameters(), lr=0.0003, weight_decay=1e-5)
@@ -272,11 +241,10 @@ for epoch in range(n_epochs):
         acc = (logits.argmax(dim=-1) == labels.to(device)).float().mean()
 
         # Record the loss and accuracy.
-        train_loss.append(loss.item())
-        train_accs.append(acc)
+        metrics.update(loss=loss, acc=acc)
         
-    train_loss = sum(train_loss) / len(train_loss)
-    train_acc = sum(train_accs) / len(train_accs)
+    means = metrics.means()
+    train_loss, train_acc = means['loss'], means['acc']
 
     
     # Print the information.
@@ -287,8 +255,7 @@ for epoch in range(n_epochs):
     model.eval()
 
     # These are used to record information in validation.
-    valid_loss = []
-    valid_accs = []
+    metrics = MetricAccumulator(device) # read back once per epoch, not after every batch
 
     # Iterate the validation set by batches.
     for batch in tqdm(valid_loader):
@@ -309,13 +276,12 @@ for epoch in range(n_epochs):
         acc = (logits.argmax(dim=-1) == labels.to(device)).float().mean()
 
         # Record the loss and accuracy.
-        valid_loss.append(loss.item())
-        valid_accs.append(acc)
+        metrics.update(loss=loss, acc=acc)
         #break
 
     # The average loss and accuracy for entire validation set is the average of the recorded values.
-    valid_loss = sum(valid_loss) / len(valid_loss)
-    valid_acc = sum(valid_accs) / len(valid_accs)
+    means = metrics.means()
+    valid_loss, valid_acc = means['loss'], means['acc']
 
     # Print the information.
     print(f"[ Valid | {epoch + 1:03d}/{n_epochs:03d} ] loss = {valid_loss:.5f}, acc = {valid_acc:.5f}")